@@ -2,105 +2,228 @@
 from pydub import AudioSegment
 import librosa
 import numpy as np
-from scipy.io.wavfile import write
 from typing import Tuple
-from pydub.silence import detect_leading_silence
 import math
+import os
+import tempfile
 import pyrubberband as pyrb
 
-trim_leading_silence = lambda x: x[detect_leading_silence(x) :]
-trim_trailing_silence = lambda x: trim_leading_silence(x.reverse()).reverse()
-strip_silence = lambda x: trim_trailing_silence(trim_leading_silence(x))
+RUBBERBAND_ARGS = {"--crisp": "1"}
 
 
 def load_audio(mp3_path: str) -> AudioSegment:
     return AudioSegment.from_mp3(mp3_path)
 
 
-def crop_audio(audio: AudioSegment, start_ms: int, end_ms: int) -> AudioSegment:
-    return audio[start_ms:end_ms]
+def silence_bounds(
+    y: np.ndarray, sr: int, silence_threshold: float = -50.0, chunk_ms: int = 10
+) -> Tuple[int, int]:
+    """Where y starts and ends once chunk_ms chunks quieter than silence_threshold
+    dBFS are trimmed from both ends, as pydub's detect_leading_silence does, but
+    looking at every chunk at once"""
+    chunk_size = max(1, int(sr * chunk_ms / 1000))
+
+    def leading_silence(y: np.ndarray) -> int:
+        n_chunks = -(-len(y) // chunk_size)
+        padded = np.zeros(n_chunks * chunk_size, dtype=np.float32)
+        padded[: len(y)] = y
+        # the last chunk may be short, so average over its real length only
+        lengths = np.full(n_chunks, chunk_size)
+        if n_chunks:
+            lengths[-1] = len(y) - (n_chunks - 1) * chunk_size
+        rms = np.sqrt((padded.reshape(n_chunks, chunk_size) ** 2).sum(axis=1) / lengths)
+        loud = np.flatnonzero(
+            20 * np.log10(np.maximum(rms, 1e-12)) >= silence_threshold
+        )
+        return int(loud[0]) * chunk_size if len(loud) else len(y)
+
+    start = leading_silence(y)
+    return start, len(y) - leading_silence(y[start:][::-1])
+
+
+def segment_to_array(audio: AudioSegment) -> Tuple[np.ndarray, int]:
+    """Converts a pydub segment to mono float32 samples in [-1, 1], the same as
+    exporting it to a wav and reading that back with librosa.load, but without
+    going via the disk."""
+    y = np.array(audio.get_array_of_samples(), dtype=np.float32)
+    if audio.channels > 1:
+        y = y.reshape((-1, audio.channels)).mean(axis=1)
+    y /= float(1 << (8 * audio.sample_width - 1))
+    return y, audio.frame_rate
+
+
+def resample(
+    y: np.ndarray, orig_sr: float, target_sr: float, quality: str = "soxr_hq"
+) -> np.ndarray:
+    """Resamples y with librosa's res_type quality, unless it's already at
+    target_sr (librosa would still run it through the filter)"""
+    if orig_sr == target_sr:
+        return y
+    return librosa.resample(y, orig_sr=orig_sr, target_sr=target_sr, res_type=quality)
 
 
 def stretch_audio(
     audio: np.ndarray, sr: float, target_duration: float
 ) -> Tuple[np.ndarray, float]:
-    """Stretches an audio segment, attempting to avoid any helicopter-esque noises.
-    If the stretch factor is more than 2 (i.e. rate < 0.5), rather than actually
-    stretching it, this just copies the middle 50% of the audio for as many times
-    as needed to get the duration up. Otherwise, the librosa stretch function is used.
-    """
+    """Stretches audio to last target_duration seconds with rubberband, without
+    changing its pitch"""
     original_duration = librosa.get_duration(y=audio, sr=sr)
     rate = original_duration / target_duration
-    return pyrb.time_stretch(audio, int(sr), rate, rbargs={"--crisp": "1"}), sr
-    # if rate == 1:
-    #     return audio, sr
-    # if rate >= 0.5:
-    #     return librosa.effects.time_stretch(audio, rate=rate), sr
-    # stretch_factor = 1 / rate
-    # start, middle, end = (
-    #     audio[: len(audio) // 4],
-    #     audio[len(audio) // 4 : 3 * len(audio) // 4],
-    #     audio[3 * len(audio) // 4 :],
-    # )
-    # middle_stretched: np.ndarray = np.repeat(
-    #     librosa.effects.time_stretch(middle, rate=0.5), (stretch_factor - 0.5) // 2
-    # )
-    # middle_stretched = np.concatenate(
-    #     middle_stretched,
-    #     librosa.effects.time_stretch(
-    #         middle, rate=0.5 / ((stretch_factor - 0.5) - (stretch_factor - 0.5) // 2)
-    #     ),
-    # )
-    # return np.concatenate((start, middle_stretched, end)), sr
+    return pyrb.time_stretch(audio, int(sr), rate, rbargs=dict(RUBBERBAND_ARGS)), sr
 
 
-def detect_average_pitch(audio: np.ndarray, sr: float) -> float:
+class PitchContour:
+    """Frame-level f0 of some audio, as detected by pyin"""
+
+    def __init__(self, f0: np.ndarray, voiced: np.ndarray, hop_length: int):
+        self.f0 = f0
+        """f0 of each frame in Hz; NaN where unvoiced"""
+
+        self.voiced = voiced
+        """whether each frame is voiced"""
+
+        self.hop_length = hop_length
+        """frame i is centred on sample i * hop_length"""
+
+    def frames(self, start: int, end: int) -> slice:
+        """the frames centred within samples [start, end)"""
+        return slice(-(-start // self.hop_length), -(-end // self.hop_length))
+
+    def average(self, start: int, end: int) -> float:
+        """median f0 of the voiced frames within samples [start, end); NaN if none
+        of them are voiced"""
+        frames = self.frames(start, end)
+        f0 = self.f0[frames][self.voiced[frames]]
+        return float(np.nanmedian(f0)) if len(f0) else math.nan
+
+
+def track_pitch(audio: np.ndarray, sr: float) -> PitchContour:
+    hop_length = 512
+    # sr isn't passed on, so pyin assumes librosa's default of 22050Hz and reports
+    # pitches an octave low for 44.1kHz audio; the octave_change of -1 in
+    # parse_mxml cancels this out, so leave the two alone together
     f0, voiced_flag, voiced_probs = librosa.pyin(
         audio,
         fmin=float(librosa.note_to_hz("C2")),
         fmax=float(librosa.note_to_hz("C7")),
+        hop_length=hop_length,
+    )
+    if sr != 44100:
+        # at other rates, scale to what it would have reported at 44.1kHz
+        f0 = f0 * (sr / 44100)
+    return PitchContour(f0, voiced_flag, hop_length)
+
+
+def detect_average_pitch(audio: np.ndarray, sr: float) -> float:
+    return track_pitch(audio, sr).average(0, len(audio))
+
+
+SMOOTHING_FRAMES = 5
+"""width of the moving average applied to pitch correction ratios, in frames"""
+
+
+def correction_ratios(contour: PitchContour, target_f0: np.ndarray) -> np.ndarray:
+    """The frequency ratio needed to move each frame of contour to target_f0 (one
+    target per frame). Unvoiced frames take the ratio of the voiced frames around
+    them, and the result is smoothed in log space so that the shift glides rather
+    than jumps. If nothing is voiced, the audio is left alone."""
+    log_ratios = np.log2(target_f0) - np.log2(contour.f0)
+    voiced = contour.voiced & np.isfinite(log_ratios)
+    if not np.any(voiced):
+        return np.ones(len(target_f0))
+    frames = np.arange(len(log_ratios))
+    log_ratios = np.interp(frames, frames[voiced], log_ratios[voiced])
+    if len(log_ratios) >= SMOOTHING_FRAMES:
+        padded = np.pad(log_ratios, SMOOTHING_FRAMES // 2, mode="edge")
+        log_ratios = np.convolve(
+            padded, np.ones(SMOOTHING_FRAMES) / SMOOTHING_FRAMES, mode="valid"
+        )
+    return 2**log_ratios
+
+
+def shift_pitch(
+    y: np.ndarray, sr: float, ratios: np.ndarray, hop_length: int
+) -> np.ndarray:
+    """Shifts the pitch of y by a ratio that varies over time, keeping its length.
+    ratios has one entry per frame of hop_length samples (as a PitchContour does).
+    This is done in a single pass: a phase vocoder stretches each frame by its
+    ratio, then the stretched audio is read back at a matching varying speed, which
+    restores the original timing and raises the pitch by the ratio. Reading back
+    faster than real time lowers the Nyquist frequency, so each stretched frame is
+    band-limited to what its read-back speed can carry before it's resynthesised."""
+    n_fft = 2048
+    D = librosa.stft(y, n_fft=n_fft, hop_length=hop_length)
+    n_frames = D.shape[-1]
+    frames = np.arange(n_frames)
+    ratios = np.interp(frames, np.arange(len(ratios)), ratios)
+
+    # position of each input frame in the stretched output, in frames
+    out_pos = np.concatenate(([0.0], np.cumsum(ratios[:-1])))
+    steps = np.interp(np.arange(0, out_pos[-1]), out_pos, frames)
+
+    # phase vocoder, as librosa.phase_vocoder but with a varying rate; the phase
+    # increments don't depend on the accumulated phase, so they can be summed up
+    # all at once
+    magnitudes = np.pad(np.abs(D), [(0, 0), (0, 2)])
+    phases = np.pad(np.angle(D), [(0, 0), (0, 2)])
+    phi_advance = np.linspace(0, np.pi * hop_length, D.shape[-2])[:, np.newaxis]
+    step_frames = steps.astype(int)
+    alpha = steps - step_frames
+    magnitude = (1 - alpha) * magnitudes[:, step_frames] + alpha * magnitudes[
+        :, step_frames + 1
+    ]
+    dphase = phases[:, step_frames + 1] - phases[:, step_frames] - phi_advance
+    dphase -= 2 * np.pi * np.round(dphase / (2 * np.pi))
+    phase = np.cumsum(phi_advance + dphase, axis=1) - (phi_advance + dphase)
+    phase += phases[:, :1]
+
+    # where the read-back is faster than real time, anything above sr / 2 / ratio
+    # would fold back down as aliasing, so drop those bins from that frame
+    cutoff = 1 / np.maximum(np.interp(steps, frames, ratios), 1)
+    magnitude *= np.linspace(0, 1, D.shape[-2])[:, np.newaxis] <= cutoff
+    stretched = librosa.istft(
+        magnitude * np.exp(1j * phase), hop_length=hop_length, n_fft=n_fft
+    )
+
+    # read the stretched audio back so that sample n of the output comes from the
+    # point that input sample n was stretched to
+    read_pos = hop_length * np.interp(np.arange(len(y)) / hop_length, frames, out_pos)
+    return np.interp(read_pos, np.arange(len(stretched)), stretched, right=0).astype(
+        np.float32
     )
-    f0 = f0[voiced_flag]  # Keep only voiced frames
-    avg_pitch = np.nanmedian(
-        f0
-    )  # Compute the median of detected pitches, ignoring NaNs
-    return avg_pitch
 
 
 def adjust_pitch(
-    y: np.ndarray, sr: float, target_pitch: float
+    y: np.ndarray,
+    sr: float,
+    target_pitch: float | np.ndarray,
+    contour: PitchContour | None = None,
 ) -> Tuple[np.ndarray, float]:
-    y_harmonic, y_percussive = librosa.effects.hpss(y)
-    # analyse in 0.1s chunks
-    h_chunks = [y[i : i + int(0.1 * sr)] for i in range(0, len(y), int(0.1 * sr))]
-    h_shifted = np.array([])
-    for chunk in h_chunks:
-        current_pitch = detect_average_pitch(chunk, sr)
-        if math.isnan(current_pitch):
-            # print('nan')
-            h_shifted = np.append(h_shifted, chunk)
-            continue
-        n_steps = np.log2(target_pitch / current_pitch) * 12
-        _shifted = librosa.effects.pitch_shift(chunk, sr=sr, n_steps=n_steps)
-        h_shifted = np.append(h_shifted, _shifted)
-    # save_audio(h_shifted, sr, 'tmp.wav')
-    # save_audio(y_percussive, sr, 'tmp2.wav')
-    # pd_shifted = AudioSegment.from_file('tmp.wav')
-    # pd_percussive = AudioSegment.from_file('tmp2.wav')
-    # pd_combined = pd_shifted.overlay(pd_percussive)
-    # pd_combined.export("tmp.wav", format="wav")
-    # new_y, new_sr = librosa.load("tmp.wav", sr=None)
-    return h_shifted, float(sr)
-
-
-def save_audio(y: np.ndarray, sr: int | float, file_name: str) -> None:
-    write(file_name, int(sr), y.astype(np.float32))
-
-
-def concatenate_audio(
-    existing_audio_path: str, new_audio_path: str, output_path: str
-) -> None:
-    existing_audio = AudioSegment.from_file(existing_audio_path)
-    new_audio = AudioSegment.from_file(new_audio_path)
-    combined = existing_audio + new_audio
-    combined.export(output_path, format="mp3")
+    """Tunes y to target_pitch, which is either a single pitch or one per frame of
+    contour. contour is the pitch of y; if it isn't given, it's tracked here."""
+    if contour is None:
+        contour = track_pitch(y, sr)
+    target_f0 = np.broadcast_to(target_pitch, contour.f0.shape)
+    ratios = correction_ratios(contour, target_f0)
+    return shift_pitch(y, sr, ratios, contour.hop_length), float(sr)
+
+
+def stretch_and_shift_audio(
+    y: np.ndarray, sr: int, target_samples: int, ratios: np.ndarray, hop_length: int
+) -> np.ndarray:
+    """Stretches y to target_samples and shifts its pitch by a ratio that varies
+    over time (one per frame of hop_length input samples), all in one rubberband
+    invocation, using a time map for the stretch and a pitch map for the shift."""
+    pitch_map = tempfile.NamedTemporaryFile(mode="w", suffix=".txt", delete=False)
+    try:
+        for i, ratio in enumerate(ratios):
+            pitch_map.write(f"{i * hop_length} {12 * np.log2(ratio)}\n")
+        pitch_map.close()
+        return pyrb.timemap_stretch(
+            y,
+            sr,
+            [(0, 0), (len(y), target_samples)],
+            rbargs={**RUBBERBAND_ARGS, "--pitchmap": pitch_map.name},
+        )
+    finally:
+        os.unlink(pitch_map.name)
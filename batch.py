@@ -0,0 +1,210 @@
+"""Renders many scores in one process. Words are fetched once for every score in
+the batch, before anything is rendered, and the notes of every score are
+scheduled on one worker pool, so the pool keeps rendering the next score's notes
+while the last of the current one's are mixed and written, and notes that come
+up in several scores are only rendered once.
+
+python3 batch.py songbook.json [main.py options]
+
+The manifest lists the jobs, each with the score (without .musicxml), the parts
+to sing, where to write the output (by default score.wav) and optionally any of
+main.py's options for that job alone (as in the server, a list for options that
+take several values and true for flags):
+
+{"jobs": [
+    {"score": "baa", "parts": ["Tenor", "Tenor 2", "Bass"], "output": "baa.wav"},
+    {"score": "hymn", "parts": ["Bass"], "options": {"gain": [-3]}}
+]}
+
+Options on the command line apply to every job. The ones that are about the batch
+as a whole (--jobs, --tts-*, the note cache, --check, --trace and --stats) can
+only be given there."""
+
+from argparse import ArgumentParser, Namespace
+from time import perf_counter
+from typing import Dict, List, Set, Tuple
+import json
+
+from main import (
+    check,
+    check_args,
+    load_score,
+    make_arg_parser,
+    needed_words,
+    output_path,
+    render_settings,
+    write_render,
+)
+from note_cache import NoteCache
+from parse_mxml import Note
+from stems import StemStore
+from tracing import tracer
+from tts import tts
+from util import error
+from word_pack import pack_words
+import render
+
+SHARED = {
+    "jobs",
+    "tts_workers",
+    "tts_rate",
+    "tts_batch",
+    "note_cache",
+    "note_cache_size",
+    "no_note_cache",
+    "check",
+    "trace",
+    "stats",
+}
+"""options that apply to the whole batch, so can't be set for a single job"""
+
+
+def job_args(job: Dict, common: List[str]) -> List[str]:
+    """main.py's command line for a job in the manifest"""
+    if "score" not in job or not job.get("parts"):
+        error(f"every job needs a score and parts: {json.dumps(job)}")
+    args = [job["score"], *job["parts"], *common]
+    for key, value in job.get("options", {}).items():
+        if key.replace("-", "_") in SHARED or key == "output":
+            error(f"{key} can't be set for a single job")
+        if value is True:
+            args.append(f"--{key.replace('_', '-')}")
+        elif value is not False and value is not None:
+            values = value if isinstance(value, list) else [value]
+            args += [f"--{key.replace('_', '-')}", *map(str, values)]
+    return args + (["--output", job["output"]] if job.get("output") else [])
+
+
+def read_manifest(path: str, common: List[str]) -> List[Namespace]:
+    with open(path) as f:
+        manifest = json.load(f)
+    arg_parser = make_arg_parser()
+    jobs = [arg_parser.parse_args(job_args(job, common)) for job in manifest["jobs"]]
+    outputs: Set[str] = set()
+    for args in jobs:
+        if args.output == "-":
+            error("jobs in a batch can't write to stdout")
+        if (path := output_path(args)) in outputs:
+            error(f"more than one job writes to {path}")
+        outputs.add(path)
+        check_args(args)
+    return jobs
+
+
+def main() -> None:
+    arg_parser = ArgumentParser(
+        description="sing many MusicXML scores, sharing words and workers",
+        epilog="any other options are passed on to main.py for every job",
+    )
+    arg_parser.add_argument("manifest", help="JSON file listing the jobs")
+    batch_args, common = arg_parser.parse_known_args()
+
+    jobs = read_manifest(batch_args.manifest, common)
+    if not jobs:
+        error("the manifest has no jobs")
+    # the same for every job
+    shared = jobs[0]
+
+    tracer.enabled = shared.trace is not None or shared.stats
+
+    loaded: List[
+        Tuple[Dict[str, List[Note]], Dict[str, List[str]], float, float | None]
+    ] = [load_score(args) for args in jobs]
+    needed = [needed_words(events) for events, _, _, _ in loaded]
+    all_needed = set().union(*needed)
+    # parts of different jobs can have the same name
+    full_texts = {
+        f"{n}/{part}": words
+        for n, (_, texts, _, _) in enumerate(loaded)
+        for part, words in texts.items()
+    }
+    print(
+        f"{len(jobs)} jobs sing {sum(map(len, needed))} words, "
+        f"{len(all_needed)} of them different"
+    )
+
+    if shared.check:
+        for args, (events, texts, _, _), job_needed in zip(jobs, loaded, needed):
+            print(f"{args.file_name} -> {output_path(args)}:")
+            check(events, texts, job_needed, args)
+        return
+
+    with tracer.span("tts"):
+        words_map = tts(
+            full_texts,
+            shared.tts_workers,
+            shared.tts_rate,
+            shared.tts_batch,
+            all_needed,
+        )
+
+    settings = [render_settings(args) for args in jobs]
+    packs: Dict[Tuple[int, str], Set[str]] = {}
+    for job_settings, job_needed in zip(settings, needed):
+        key = (job_settings["target_sr"], job_settings["resample_quality"])
+        packs.setdefault(key, set()).update(job_needed)
+    for (sr, quality), words in packs.items():
+        pack_words(words, words_map, sr, quality)
+
+    cache = (
+        None
+        if shared.no_note_cache
+        else NoteCache(shared.note_cache, max_bytes=shared.note_cache_size << 20)
+    )
+    renderer = render.NoteRenderer(shared.jobs, cache)
+
+    timelines = [
+        render.Timeline(
+            events,
+            words_map,
+            job_settings,
+            StemStore(f"{args.file_name}.render") if args.incremental else None,
+            start_ms,
+            end_ms,
+        )
+        for args, job_settings, (events, _, start_ms, end_ms) in zip(
+            jobs, settings, loaded
+        )
+    ]
+    # everything is scheduled up front, so that the pool's lookahead runs on
+    # into the next job
+    for timeline in timelines:
+        timeline.schedule(renderer)
+
+    batch_start = perf_counter()
+    batch_audio = 0.0
+    try:
+        for n, (args, timeline, (events, _, _, _)) in enumerate(
+            zip(jobs, timelines, loaded)
+        ):
+            print(
+                f"[{n + 1}/{len(jobs)}] {args.file_name} -> {output_path(args)}: "
+                f"{len(events)} parts, {timeline.notes()} notes"
+            )
+            start = perf_counter()
+            with tracer.span("job", file=args.file_name, output=output_path(args)):
+                write_render(args, events, timeline, renderer)
+            seconds = perf_counter() - start
+            audio = timeline.total_samples / timeline.target_sr
+            batch_audio += audio
+            print(
+                f"[{n + 1}/{len(jobs)}] {output_path(args)}: {audio:.1f}s of audio in "
+                f"{seconds:.1f}s ({audio / seconds:.1f}x real time)"
+            )
+    finally:
+        renderer.close()
+
+    seconds = perf_counter() - batch_start
+    print(
+        f"{len(jobs)} jobs: {batch_audio:.1f}s of audio in {seconds:.1f}s "
+        f"({batch_audio / seconds:.1f}x real time)"
+    )
+
+    if shared.trace is not None:
+        tracer.write(shared.trace)
+    if shared.stats:
+        print(tracer.stats())
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,369 @@
+"""Benchmarks each stage of rendering, offline. Words are served by a fake TTS
+provider (a tone with evenly spaced character timings) instead of elevenlabs, so
+runs are repeatable and free. Each scenario runs in its own process, so that its
+peak RSS isn't affected by the others, and the results are written as JSON so
+they can be compared between commits.
+
+python3 bench.py [--scenario NAME ...] [--engine ENGINE] [--output bench.json]"""
+
+from argparse import SUPPRESS, ArgumentParser
+from contextlib import contextmanager
+from time import perf_counter
+from typing import Callable, Dict, Iterator, List, Set, Tuple, TypedDict
+import io
+import json
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import numpy as np
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+FAKE_TTS_SR = 24000
+
+
+class Scenario(TypedDict):
+    parts: int
+    measures: int
+    notes_per_syllable: int
+    """more than 1 gives melismas"""
+
+
+SCENARIOS: Dict[str, Scenario | None] = {
+    "baa": None,
+    "many-parts": {"parts": 8, "measures": 8, "notes_per_syllable": 1},
+    "long": {"parts": 1, "measures": 96, "notes_per_syllable": 1},
+    "melisma": {"parts": 2, "measures": 16, "notes_per_syllable": 4},
+}
+"""baa is baa.musicxml; the rest are generated by synthetic_score"""
+
+STAGES = [
+    "parse",
+    "tts_lookup",
+    "decode",
+    "analyse",
+    "stretch",
+    "stretch+shift",
+    "pitch_detection",
+    "pitch_shift",
+    "render",
+    "mix",
+    "export",
+]
+"""render is the whole of rendering the notes, including stretch and pitch_shift.
+stretch+shift is the rubberband engine's single pass that does both, which can't
+be split between them; with that engine, stretch stays at 0 and pitch_shift is
+only working out the correction ratios.
+analyse is analysing each word as it's packed, including pitch_detection (which
+is now only done there); it isn't counted in decode"""
+
+WORDS = ["sing", "la", "ah", "oh", "bright", "star", "moon", "sea", "light"]
+TWO_SYLLABLE_WORDS = [("hap", "py"), ("mor", "ning"), ("sil", "ver")]
+
+STEPS = [("C", 0), ("D", 0), ("E", 0), ("F", 0), ("G", 0), ("A", 0), ("B", -1)]
+
+
+def synthetic_score(parts: int, measures: int, notes_per_syllable: int) -> str:
+    """A MusicXML score of crotchets in 4/4, with a mixture of one and two syllable
+    words, and notes_per_syllable notes sung to each syllable"""
+    part_list = "".join(
+        f'<score-part id="P{p + 1}"><part-name>Part {p + 1}</part-name></score-part>'
+        for p in range(parts)
+    )
+    part_xml: List[str] = []
+    for p in range(parts):
+        syllables: List[Tuple[str, str]] = []
+        measure_xml: List[str] = []
+        note = 0
+        for m in range(measures):
+            notes: List[str] = []
+            for _ in range(4):
+                step, alter = STEPS[(note + 2 * p) % len(STEPS)]
+                lyric = ""
+                if note % notes_per_syllable == 0:
+                    if not syllables:
+                        word = note // notes_per_syllable
+                        if word % 3 == 2:
+                            first, second = TWO_SYLLABLE_WORDS[
+                                word % len(TWO_SYLLABLE_WORDS)
+                            ]
+                            syllables = [("begin", first), ("end", second)]
+                        else:
+                            syllables = [("single", WORDS[word % len(WORDS)])]
+                    syllabic, text = syllables.pop(0)
+                    lyric = (
+                        f"<lyric><syllabic>{syllabic}</syllabic>"
+                        f"<text>{text}</text></lyric>"
+                    )
+                notes.append(
+                    f"<note><pitch><step>{step}</step><alter>{alter}</alter>"
+                    f"<octave>{4 - p % 2}</octave></pitch><duration>1</duration>"
+                    f"{lyric}</note>"
+                )
+                note += 1
+            attributes = (
+                "<attributes><divisions>1</divisions><time><beats>4</beats>"
+                "<beat-type>4</beat-type></time></attributes>"
+                '<direction><sound tempo="100"/></direction>'
+                if m == 0
+                else ""
+            )
+            measure_xml.append(
+                f'<measure number="{m + 1}">{attributes}{"".join(notes)}</measure>'
+            )
+        part_xml.append(f'<part id="P{p + 1}">{"".join(measure_xml)}</part>')
+    return (
+        '<?xml version="1.0" encoding="UTF-8"?>'
+        f'<score-partwise version="4.0"><part-list>{part_list}</part-list>'
+        f'{"".join(part_xml)}</score-partwise>'
+    )
+
+
+def fake_tts(text: str, *_args, **_kwargs) -> Dict:
+    """Stands in for tts.streaming_tts: a harmonic tone (so that pyin has something
+    to track) with a little silence either side, and the characters spread evenly
+    over the tone"""
+    from pydub import AudioSegment
+
+    lead = 0.05
+    voiced = 0.08 * len(text) + 0.1
+    t = np.arange(int(voiced * FAKE_TTS_SR)) / FAKE_TTS_SR
+    tone = sum(np.sin(2 * np.pi * 130 * h * t) / h for h in range(1, 6)) * 0.3
+    silence = np.zeros(int(lead * FAKE_TTS_SR))
+    y = np.concatenate([silence, tone, silence])
+    segment = AudioSegment(
+        data=(y * 32767).astype("<i2").tobytes(),
+        sample_width=2,
+        frame_rate=FAKE_TTS_SR,
+        channels=1,
+    )
+    audio_bytes = io.BytesIO()
+    segment.export(audio_bytes, format="mp3")
+    step = voiced / len(text)
+    return {
+        "audio_bytes": audio_bytes.getvalue(),
+        "character_start_times": [lead + i * step for i in range(len(text))],
+        "character_end_times": [lead + (i + 1) * step for i in range(len(text))],
+        "characters": list(text),
+    }
+
+
+class StageTimer:
+    """Accumulates the wall time and number of calls of each stage, along with the
+    peak RSS at the end of each"""
+
+    def __init__(self) -> None:
+        self.seconds: Dict[str, float] = {stage: 0.0 for stage in STAGES}
+        self.calls: Dict[str, int] = {stage: 0 for stage in STAGES}
+        self.peak_rss: Dict[str, int] = {stage: 0 for stage in STAGES}
+        self.active: Set[str] = set()
+
+    @contextmanager
+    def stage(self, name: str) -> Iterator[None]:
+        if name in self.active:
+            # already being timed further up the stack
+            yield
+            return
+        self.active.add(name)
+        start = perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += perf_counter() - start
+            self.calls[name] += 1
+            # ru_maxrss is in KiB on Linux
+            self.peak_rss[name] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+            self.active.remove(name)
+
+    def wrap(self, module: object, attr: str, name: str) -> None:
+        """times every call of module.attr as stage name"""
+        func: Callable = getattr(module, attr)
+
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return func(*args, **kwargs)
+
+        setattr(module, attr, timed)
+
+
+def run_scenario(name: str, engine: str) -> Dict:
+    """Renders one scenario in a scratch directory, timing every stage"""
+    work_dir = tempfile.mkdtemp(prefix=f"bench-{name}-")
+    os.chdir(work_dir)
+    scenario = SCENARIOS[name]
+    if scenario is None:
+        shutil.copy(os.path.join(REPO_DIR, "baa.musicxml"), work_dir)
+        file_name, part_names = "baa", ["Tenor", "Tenor 2", "Bass"]
+    else:
+        with open("synthetic.musicxml", "w") as f:
+            f.write(synthetic_score(**scenario))
+        file_name = "synthetic"
+        part_names = [f"Part {p + 1}" for p in range(scenario["parts"])]
+
+    sys.path.insert(0, REPO_DIR)
+    # imported here, so that the word cache ends up in the scratch directory
+    from parse_mxml import score_from_mxml, total_duration
+    from output import write_wav
+    from word_pack import pack_words
+    import word_pack
+    import audio
+    import mixer
+    import render
+    import tts
+
+    timer = StageTimer()
+    timer.wrap(audio, "stretch_audio", "stretch")
+    timer.wrap(audio, "stretch_and_shift_audio", "stretch+shift")
+    timer.wrap(word_pack, "analyse_word", "analyse")
+    timer.wrap(audio, "track_pitch", "pitch_detection")
+    timer.wrap(audio, "adjust_pitch", "pitch_shift")
+    timer.wrap(audio, "correction_ratios", "pitch_shift")
+    setattr(tts, "streaming_tts", fake_tts)
+
+    with timer.stage("parse"):
+        score = score_from_mxml(f"{file_name}.musicxml", part_names, file_name)
+        full_texts = {part: table.join_lyrics() for part, table in score.parts.items()}
+        events = {part_id: table.to_notes() for part_id, table in score.parts.items()}
+
+    # fill the word cache from the fake provider first, so that what's timed is
+    # looking words up, as it is for a score whose words have all been fetched
+    tts.tts(full_texts)
+    with timer.stage("tts_lookup"):
+        words_map = tts.tts(full_texts)
+
+    settings: render.RenderSettings = {
+        "target_sr": 44100,
+        "engine": engine,
+        "resample_quality": "soxr_hq",
+    }
+    with timer.stage("decode"):
+        pack_words(words_map, words_map, settings["target_sr"])
+    # analysing happens in the middle of packing, but is reported on its own
+    timer.seconds["decode"] -= timer.seconds["analyse"]
+
+    parts: List[np.ndarray] = []
+    with timer.stage("render"):
+        for parts, _ in render.render_timeline(events, words_map, settings):
+            pass
+
+    with timer.stage("mix"):
+        y = mixer.mix(parts)
+
+    with timer.stage("export"):
+        write_wav(f"{file_name}.wav", y, settings["target_sr"])
+
+    os.chdir(REPO_DIR)
+    shutil.rmtree(work_dir)
+
+    audio_seconds = total_duration(events) / 1000
+    return {
+        "parts": len(events),
+        "notes": sum(len(evs) for evs in events.values()),
+        "audio_seconds": audio_seconds,
+        "peak_rss_mb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024,
+        "stages": {
+            stage: {
+                "seconds": timer.seconds[stage],
+                "calls": timer.calls[stage],
+                "peak_rss_mb": timer.peak_rss[stage] / 1024,
+                # seconds of audio per second of this stage
+                "throughput": (
+                    audio_seconds / timer.seconds[stage]
+                    if timer.seconds[stage]
+                    else None
+                ),
+            }
+            for stage in STAGES
+        },
+    }
+
+
+def git_commit() -> str | None:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "HEAD"],
+            cwd=REPO_DIR,
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main() -> None:
+    arg_parser = ArgumentParser(description="benchmark each stage of rendering")
+    arg_parser.add_argument(
+        "--scenario",
+        nargs="+",
+        choices=list(SCENARIOS),
+        default=list(SCENARIOS),
+        help="scenarios to run (default: all of them)",
+    )
+    arg_parser.add_argument(
+        "--engine",
+        choices=["vocoder", "rubberband"],
+        default="vocoder",
+        help="engine to render with (default: vocoder)",
+    )
+    arg_parser.add_argument(
+        "--output",
+        default="-",
+        metavar="PATH",
+        help="where to write the results, or - for stdout (default: -)",
+    )
+    arg_parser.add_argument("--run-scenario", help=SUPPRESS)
+    arg_parser.add_argument("--result", help=SUPPRESS)
+    args = arg_parser.parse_args()
+
+    if args.run_scenario is not None:
+        # this is a child process running a single scenario; the renderer's
+        # progress output goes to stdout, so the result goes to a file
+        result = run_scenario(args.run_scenario, args.engine)
+        with open(args.result, "w") as f:
+            json.dump(result, f)
+        return
+
+    results: Dict[str, Dict] = {}
+    for name in args.scenario:
+        print(f"running {name}", file=sys.stderr)
+        with tempfile.NamedTemporaryFile(suffix=".json") as result_file:
+            wall_start = perf_counter()
+            subprocess.run(
+                [
+                    sys.executable,
+                    os.path.abspath(__file__),
+                    "--run-scenario",
+                    name,
+                    "--engine",
+                    args.engine,
+                    "--result",
+                    result_file.name,
+                ],
+                stdout=subprocess.DEVNULL,
+                check=True,
+            )
+            with open(result_file.name) as f:
+                results[name] = json.load(f)
+            # including interpreter startup and imports
+            results[name]["wall_seconds"] = perf_counter() - wall_start
+
+    report = {
+        "commit": git_commit(),
+        "python": sys.version.split()[0],
+        "engine": args.engine,
+        "scenarios": results,
+    }
+    if args.output == "-":
+        json.dump(report, sys.stdout, indent=2)
+        print()
+    else:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
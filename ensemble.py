@@ -0,0 +1,82 @@
+from typing import List
+import numpy as np
+
+MAX_OFFSET_MS = 30.0
+"""the furthest behind the rendered part an extra singer can come in"""
+
+MAX_DETUNE_CENTS = 8.0
+"""the furthest out of tune an extra singer drifts"""
+
+MAX_GAIN_DB = -3.0
+"""the quietest an extra singer sings, relative to the rendered part"""
+
+
+class Section:
+    """The extra singers of one part. Each is a copy of the rendered part read
+    through a delay that drifts slowly back and forth, which puts them slightly
+    behind the beat and (since a changing delay bends the pitch) slightly out of
+    tune, with a slowly wavering gain. Everything is a function of the sample
+    position, so rendering a block at a time gives the same result as rendering
+    the whole part."""
+
+    def __init__(self, voices: int, sr: int, rng: np.random.Generator):
+        column = lambda low, high: rng.uniform(low, high, (voices, 1))
+        self.offset = column(0.2, 1.0) * MAX_OFFSET_MS * 0.001 * sr
+        """the delay each singer drifts from, in samples"""
+
+        self.rate = 2 * np.pi * column(0.1, 0.4) / sr
+        """how fast each singer's delay drifts, in radians per sample"""
+
+        cents = column(0.3, 1.0) * MAX_DETUNE_CENTS
+        # a delay of depth * sin(rate * t) changes the pitch by up to depth * rate
+        self.depth = (2 ** (cents / 1200) - 1) / self.rate
+        self.phase = column(0, 2 * np.pi)
+        self.gain = 10 ** (column(2 * MAX_GAIN_DB, MAX_GAIN_DB) / 20)
+        self.gain_rate = 2 * np.pi * column(0.05, 0.3) / sr
+        self.gain_phase = column(0, 2 * np.pi)
+        self.max_delay = int(np.ceil(np.max(self.offset + 2 * self.depth, initial=0)))
+
+    def sing(self, part: np.ndarray, start: int, end: int) -> np.ndarray:
+        """the extra singers' samples [start, end) of part, summed"""
+        t = np.arange(start, end)
+        delay = self.offset + self.depth * (1 + np.sin(self.rate * t + self.phase))
+        position = t - delay
+        index = np.floor(position).astype(np.int64)
+        frac = (position - index).astype(np.float32)
+
+        # only the stretch of the part the delays can reach is read, so a part in
+        # a memory-mapped file isn't pulled in as a whole
+        window_start = max(start - self.max_delay - 1, 0)
+        window = np.zeros(end - window_start + 1, dtype=np.float32)
+        window[: end - window_start] = part[window_start:end]
+        index -= window_start
+        # before the start of the part is silence, as is the padding at the end
+        index[index < 0] = len(window) - 1
+        after = np.minimum(index + 1, len(window) - 1)
+        y = window[index] * (1 - frac) + window[after] * frac
+
+        gain = self.gain * (1 + 0.15 * np.sin(self.gain_rate * t + self.gain_phase))
+        return (y * gain).sum(axis=0).astype(np.float32)
+
+
+class Ensemble:
+    """Turns each rendered part into a section of voices singers: the rendered
+    part, and voices - 1 singers derived from it by Section. Each section is
+    scaled so that it's about as loud as its part on its own. The singers are
+    chosen at random, so seed picks a different ensemble."""
+
+    def __init__(self, n_parts: int, voices: int, sr: int, seed: int = 0):
+        rng = np.random.default_rng(seed)
+        self.sections: List[Section] = [
+            Section(voices - 1, sr, rng) for _ in range(n_parts)
+        ]
+        # the singers aren't in phase, so their power adds up
+        self.scales = [
+            1 / np.sqrt(1 + np.sum(section.gain**2)) for section in self.sections
+        ]
+
+    def sing(self, i: int, part: np.ndarray, start: int, end: int) -> np.ndarray:
+        """samples [start, end) of part i sung by its whole section"""
+        y = part[start:end] + self.sections[i].sing(part, start, end)
+        y *= self.scales[i]
+        return y
@@ -1,172 +1,502 @@
-from sys import argv
-from typing import List, cast
-from util import error, s_to_ms, strip_word
-from parse_mxml import events_from_mxml, Note, Pitch
-from tts import tts, cache_path
+from argparse import ArgumentParser, Namespace
+from typing import BinaryIO, Dict, List, Set, Tuple, cast
+from util import error, strip_word
+from parse_mxml import score_from_mxml, total_duration, Note, Pitch
+from tts import plan_phrases, tts
+from note_cache import NoteCache, note_path
+from stems import MappedParts, StemStore
+from word_pack import pack_words
+from output import OutputFormat, SoundFileWriter, WavWriter, open_writer, write_audio
+import output
+from tracing import tracer
+from ensemble import Ensemble
+import mixer
+import render
 import os
-import audio
-import librosa
+import sys
+import tempfile
 import numpy as np
 
-if len(argv) < 2:
-    error("input xml file name needed")
-if len(argv) < 3:
-    error("you need to specify at least 1 part name to generate for")
-
-file_name = argv[1]
-part_names = argv[2:]
-
-try:
-    with open(f"{file_name}.musicxml") as file:
-        xml_txt = file.read()
-except:
-    error(f"couldn't read file {file_name}.musicxml")
-
-events = events_from_mxml(xml_txt, part_names, file_name)
-
-
-def join_lyrics(evs: List[Note]) -> List[str]:
-    words: List[str] = []
-    curr_word_start_idx = 0
-    prev_ev_idx = 0
-    for i, event in enumerate(evs):
-        if isinstance(event, Pitch):
-            if event.lyric is not None:
-                lyric = strip_word(event.lyric)
-                match event.lyric_pos:
-                    case 0:
-                        words.append(lyric)
-                        curr_word_start_idx = i
-                        event.lyric_start_pos = 0
-                        event.lyric_end_pos = len(lyric) - 1
-                    case 3:
-                        words.append(lyric)
-                        event.lyric_word = lyric
-                        event.lyric_start_pos = 0
-                        event.lyric_end_pos = len(lyric) - 1
-                    case 1:
-                        words[-1] += lyric
-                        event.lyric_start_pos = (
-                            cast(Pitch, evs[prev_ev_idx]).lyric_end_pos + 1
-                        )
-                        event.lyric_end_pos = len(lyric) + event.lyric_start_pos - 1
-                    case 2:
-                        words[-1] += lyric
-                        event.lyric_start_pos = (
-                            cast(Pitch, evs[prev_ev_idx]).lyric_end_pos + 1
-                        )
-                        event.lyric_end_pos = len(lyric) + event.lyric_start_pos - 1
-                        for j in range(curr_word_start_idx, i + 1):
-                            cast(Pitch, evs[j]).lyric_word = words[-1]
-            prev_ev_idx = i
-    return words
-
-
-for evs in events.values():
-    for i in range(len(evs) - 1, -1, -1):
-        ev = evs[i]
-        if isinstance(ev, Pitch) and (ev.lyric is None or ev.lyric == ""):
+
+def check(
+    events: Dict[str, List[Note]],
+    full_texts: Dict[str, List[str]],
+    needed: Set[str],
+    args: Namespace,
+) -> None:
+    """Reports what rendering would involve, without fetching or rendering
+    anything: which words aren't cached yet and what fetching them would take, and
+    how many notes would have to be rendered"""
+    words_map, phrases = plan_phrases(full_texts, args.tts_batch, needed)
+    missing = [word for words, _, _ in phrases for word in words]
+
+    settings = render_settings(args)
+    notes = [
+        event for evs in events.values() for event in evs if isinstance(event, Pitch)
+    ]
+    keys = {
+        render.note_key(render.note_job(note, words_map, settings))
+        for note in notes
+        if strip_word(note.lyric_word) in words_map
+    }
+    cached = (
+        0
+        if args.no_note_cache
+        else sum(os.path.isfile(note_path(args.note_cache, key)) for key in keys)
+    )
+    to_render = (
+        len(keys)
+        - cached
+        + sum(strip_word(note.lyric_word) not in words_map for note in notes)
+    )
+
+    print(f"{len(events)} parts, {total_duration(events) / 1000:.1f}s")
+    print(f"{len(needed)} words, {len(missing)} not cached")
+    if missing:
+        print(f"  {' '.join(missing)}")
+        print(
+            f"  fetching them would take {len(phrases)} requests "
+            f"({sum(len(' '.join(words)) for words, _, _ in phrases)} characters)"
+        )
+    print(f"{len(notes)} notes, about {to_render} to render ({cached} cached)")
+
+
+def output_format(args: Namespace) -> OutputFormat:
+    return {
+        "format": args.format or output.format_for_path(args.output or ""),
+        "depth": args.bit_depth,
+        "dither": args.dither,
+    }
+
+
+def output_path(args: Namespace) -> str:
+    return args.output or f"{args.file_name}.{output_format(args)['format']}"
+
+
+def render_settings(args: Namespace) -> render.RenderSettings:
+    return {
+        "target_sr": args.sample_rate,
+        "engine": args.engine,
+        "resample_quality": args.resample_quality,
+    }
+
+
+def make_arg_parser() -> ArgumentParser:
+    arg_parser = ArgumentParser(description="sing a MusicXML score")
+    arg_parser.add_argument("file_name", help="score name, without .musicxml")
+    arg_parser.add_argument(
+        "part_names", nargs="+", help="names of the parts to generate audio for"
+    )
+    arg_parser.add_argument(
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of processes to render notes with (default: 1)",
+    )
+    arg_parser.add_argument(
+        "--tts-workers",
+        type=int,
+        default=4,
+        help="number of words to fetch from elevenlabs at once (default: 4)",
+    )
+    arg_parser.add_argument(
+        "--tts-rate",
+        type=float,
+        default=5.0,
+        help="maximum elevenlabs requests per second (default: 5)",
+    )
+    arg_parser.add_argument(
+        "--tts-batch",
+        type=int,
+        default=1,
+        metavar="WORDS",
+        help="fetch up to this many consecutive words in one elevenlabs request, "
+        "splitting them up by their alignment (default: 1)",
+    )
+    arg_parser.add_argument(
+        "--engine",
+        choices=render.ENGINES,
+        default="vocoder",
+        help="vocoder: stretch with rubberband then tune with a phase vocoder; "
+        "rubberband: stretch and tune in one rubberband pass (default: vocoder)",
+    )
+    arg_parser.add_argument(
+        "--sample-rate",
+        type=int,
+        default=44100,
+        metavar="HZ",
+        help="sample rate to render and output at (default: 44100)",
+    )
+    arg_parser.add_argument(
+        "--resample-quality",
+        choices=render.RESAMPLE_QUALITIES,
+        default="soxr_hq",
+        help="how carefully to resample words to the sample rate, from best "
+        "(soxr_vhq) to fastest (soxr_qq) (default: soxr_hq)",
+    )
+    arg_parser.add_argument(
+        "--note-cache",
+        default="note-cache",
+        metavar="DIR",
+        help="directory to cache rendered notes in (default: note-cache)",
+    )
+    arg_parser.add_argument(
+        "--note-cache-size",
+        type=int,
+        default=1024,
+        metavar="MB",
+        help="maximum size of the note cache on disk (default: 1024)",
+    )
+    arg_parser.add_argument(
+        "--no-note-cache",
+        action="store_true",
+        help="don't reuse or save rendered notes",
+    )
+    arg_parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="keep each rendered measure in score-name.render/ and only re-render "
+        "measures that have changed since the last run",
+    )
+    arg_parser.add_argument(
+        "--output",
+        metavar="PATH",
+        help="where to write the output, or - for stdout (default: score-name.wav, "
+        "or .flac or .opus for those formats)",
+    )
+    arg_parser.add_argument(
+        "--format",
+        choices=output.FORMATS,
+        help="format to write the output in (default: from the --output file's "
+        "extension, or wav)",
+    )
+    arg_parser.add_argument(
+        "--bit-depth",
+        choices=output.DEPTHS,
+        default="16",
+        help="bits per sample of wav or flac output (default: 16)",
+    )
+    arg_parser.add_argument(
+        "--dither",
+        choices=output.DITHERS,
+        default="none",
+        help="noise to add when reducing the mix to 16 or 24 bits (default: none)",
+    )
+    arg_parser.add_argument(
+        "--stream",
+        action="store_true",
+        help="write the output as it's rendered, rather than all at the end "
+        "(always the case with --output -)",
+    )
+    arg_parser.add_argument(
+        "--gain",
+        type=float,
+        nargs="+",
+        metavar="DB",
+        help="gain of each part in dB, in the same order as the part names",
+    )
+    arg_parser.add_argument(
+        "--headroom",
+        type=float,
+        default=0.0,
+        metavar="DB",
+        help="how far to turn the whole mix down before limiting (default: 0)",
+    )
+    arg_parser.add_argument(
+        "--measures",
+        metavar="A-B",
+        help="only render measures A to B (or just measure A), by measure number",
+    )
+    arg_parser.add_argument(
+        "--from",
+        dest="from_s",
+        type=float,
+        metavar="SECONDS",
+        help="only render from this time onwards",
+    )
+    arg_parser.add_argument(
+        "--to",
+        dest="to_s",
+        type=float,
+        metavar="SECONDS",
+        help="only render up to this time",
+    )
+    arg_parser.add_argument(
+        "--trace",
+        metavar="PATH",
+        help="record how long every stage of every note takes, and save it to PATH "
+        "as a chrome trace (open it in chrome://tracing or ui.perfetto.dev)",
+    )
+    arg_parser.add_argument(
+        "--stats",
+        action="store_true",
+        help="print the stages that took the longest at the end",
+    )
+    arg_parser.add_argument(
+        "--check",
+        action="store_true",
+        help="check the score and report which words aren't cached yet and how "
+        "many notes need rendering, without fetching or rendering anything",
+    )
+    arg_parser.add_argument(
+        "--voices-per-part",
+        type=int,
+        default=1,
+        metavar="N",
+        help="sing each part with a section of N singers: the rendered part, and N - "
+        "1 more derived from it with slightly different timing, tuning and "
+        "loudness (default: 1)",
+    )
+    arg_parser.add_argument(
+        "--ensemble-seed",
+        type=int,
+        default=0,
+        metavar="SEED",
+        help="pick a different set of singers for --voices-per-part (default: 0)",
+    )
+    arg_parser.add_argument(
+        "--low-memory",
+        action="store_true",
+        help="render each part into a memory-mapped file rather than memory, and "
+        "write the mix out as it's rendered, so that memory use doesn't grow with "
+        "the length of the score",
+    )
+    arg_parser.add_argument(
+        "--block-size",
+        type=int,
+        default=mixer.BLOCK_SIZE,
+        metavar="SAMPLES",
+        help=f"number of samples to mix at a time (default: {mixer.BLOCK_SIZE})",
+    )
+    return arg_parser
+
+
+def check_args(args: Namespace) -> None:
+    if args.gain is not None and len(args.gain) != len(args.part_names):
+        error("--gain needs exactly one value per part")
+    if args.sample_rate < 8000:
+        error("--sample-rate must be at least 8000")
+    if args.jobs < 1:
+        error("--jobs must be at least 1")
+    if args.block_size < 1:
+        error("--block-size must be at least 1")
+    if args.voices_per_part < 1:
+        error("--voices-per-part must be at least 1")
+    if args.tts_workers < 1:
+        error("--tts-workers must be at least 1")
+    if args.tts_rate <= 0:
+        error("--tts-rate must be more than 0")
+    if args.tts_batch < 1:
+        error("--tts-batch must be at least 1")
+    output.check_format(output_format(args), args.sample_rate)
+    if args.output == "-" and output_format(args)["format"] == "flac":
+        error("flac can't be written to stdout; use wav or opus")
+    if args.measures is not None and (args.from_s is not None or args.to_s is not None):
+        error("--measures can't be used with --from or --to")
+
+
+def load_score(
+    args: Namespace, source: str | BinaryIO | None = None
+) -> Tuple[Dict[str, List[Note]], Dict[str, List[str]], float, float | None]:
+    """Parses the score and joins its lyrics into words. Returns the events of each
+    part in the range being rendered, the words of each whole part, and the range
+    being rendered, in ms (end_ms is None to render to the end)."""
+    file_name: str = args.file_name
+
+    with tracer.span("parse", file=file_name):
+        score = score_from_mxml(
+            f"{file_name}.musicxml" if source is None else source,
+            args.part_names,
+            file_name,
+        )
+
+    for table in score.parts.values():
+        if table.empty_lyrics():
             error("empty lyric")
 
-full_texts = {part: join_lyrics(evs) for part, evs in events.items()}
+    # lyrics are joined across the whole score first, so that words cut by the
+    # ends of the range are still whole and in context
+    full_texts = {part: table.join_lyrics() for part, table in score.parts.items()}
 
-print(full_texts)
+    print(full_texts)
 
-words_map = tts(full_texts)
+    start_ms, end_ms = 0.0, None
+    if args.measures is not None:
+        first, _, last = args.measures.partition("-")
+        start_ms, end_ms = score.measure_span(first, last or first)
+    elif args.from_s is not None or args.to_s is not None:
+        start_ms = max(args.from_s or 0.0, 0.0) * 1000
+        end_ms = min(
+            score.end_time(),
+            args.to_s * 1000 if args.to_s is not None else float("inf"),
+        )
+        if end_ms <= start_ms:
+            error("nothing to render between --from and --to")
+    # only the events in the range are made into Note objects
+    events = {
+        part_id: table.to_notes(
+            None if end_ms is None else table.overlapping(start_ms, end_ms)
+        )
+        for part_id, table in score.parts.items()
+    }
+    return events, full_texts, start_ms, end_ms
 
-whole_audio = audio.AudioSegment.empty()
 
-if not os.path.isdir("stretched"):
-    os.mkdir("stretched")
+def needed_words(events: Dict[str, List[Note]]) -> Set[str]:
+    """the words sung in events"""
+    return {
+        strip_word(event.lyric_word)
+        for evs in events.values()
+        for event in evs
+        if isinstance(event, Pitch)
+    }
 
-target_sr = 44100
 
-try:
-    for i, evs in enumerate(events.values()):
-        print(i)
-        part_y = np.array([])
-        for j, event in enumerate(evs):
-            print(sum(event.duration))
-            if isinstance(event, Pitch):
-                print(event.lyric_word)
-                if (word := strip_word(event.lyric_word)) not in words_map:
-                    error(f'"{word}" not registered')
+def write_render(
+    args: Namespace,
+    events: Dict[str, List[Note]],
+    timeline: render.Timeline,
+    renderer: render.NoteRenderer,
+    output_file: BinaryIO | None = None,
+) -> None:
+    """Renders timeline, whose notes have already been scheduled on renderer, and
+    mixes it to --output, or to output_file if it's given"""
+    path = output_path(args)
+    fmt = output_format(args)
+    owns_output = output_file is None
+    # in low memory mode the mix is never held in memory as a whole
+    stream: bool = args.stream or args.low_memory or not owns_output
+    target_sr = timeline.target_sr
 
-                word_info = words_map[word]
+    parts: List[np.ndarray] = []
 
-                word_audio = audio.load_audio(f"{cache_path(word)}.mp3")
+    writer: WavWriter | SoundFileWriter | None = None
+    if stream:
+        if output_file is None:
+            output_file = open(path, "wb")
+        writer = open_writer(output_file, target_sr, timeline.total_samples, fmt)
+    gains = mixer.part_gains(len(events), args.gain, args.headroom)
+    ensemble = (
+        Ensemble(len(events), args.voices_per_part, target_sr, args.ensemble_seed)
+        if args.voices_per_part > 1
+        else None
+    )
+    mixed_until = 0
 
-                word_audio = audio.strip_silence(
-                    audio.crop_audio(
-                        word_audio,
-                        s_to_ms(
-                            word_info["character_start_times"][event.lyric_start_pos]
-                        ),
-                        s_to_ms(word_info["character_end_times"][event.lyric_end_pos]),
-                    )
-                )
-
-                word_audio.export("tmp.wav", format="wav")
-
-                y, sr = librosa.load("tmp.wav", sr=None)
-                y = librosa.resample(y, orig_sr=sr, target_sr=target_sr)
-
-                stretched_y, sr = audio.stretch_audio(
-                    y, float(target_sr), sum(event.duration) * 0.001
-                )
-                stretched_y = librosa.resample(
-                    stretched_y, orig_sr=sr, target_sr=target_sr
-                )
-
-                tuned_y = np.array([])
-                for i in range(len(event.duration)):
-                    this_y = stretched_y[
-                        int(sum(event.duration[:i]) * 0.001 * target_sr) : int(
-                            sum(event.duration[: i + 1]) * 0.001 * target_sr
-                        )
-                    ]
-                    # print(len(stretched_y), len(this_y), event.duration)
-                    current_pitch = audio.detect_average_pitch(this_y, target_sr)
-                    target_note = [
-                        "A",
-                        "Bb",
-                        "B",
-                        "C",
-                        "C#",
-                        "D",
-                        "Eb",
-                        "E",
-                        "F",
-                        "F#",
-                        "G",
-                        "Ab",
-                    ][event.degree[i]]
-                    target_pitch = librosa.note_to_hz(f"{target_note}{event.octave[i]}")
-                    this_tuned_y, sr = audio.adjust_pitch(
-                        this_y, float(target_sr), cast(float, target_pitch)
+    mapped_dir: tempfile.TemporaryDirectory | None = None
+    mapped: MappedParts | None = None
+    if args.low_memory:
+        mapped_dir = tempfile.TemporaryDirectory(prefix="ai-singing-")
+        mapped = MappedParts(mapped_dir.name)
+
+    rendering = timeline.render(
+        renderer, mapped.allocate if mapped is not None else None
+    )
+    try:
+        for parts, ready in rendering:
+            # output everything that every part has been rendered past
+            while writer is not None and mixed_until < ready:
+                block_end = min(mixed_until + args.block_size, ready)
+                with tracer.span("mix", samples=block_end - mixed_until):
+                    block = mixer.mix_block(
+                        parts, gains, mixed_until, block_end, ensemble
                     )
-                    this_tuned_y = librosa.resample(
-                        this_tuned_y, orig_sr=sr, target_sr=target_sr
+                with tracer.span("write", samples=len(block)):
+                    writer.write(block)
+                mixed_until = block_end
+            if mapped is not None:
+                mapped.release(mixed_until)
+    finally:
+        try:
+            if writer is not None:
+                writer.close()
+                if owns_output:
+                    cast(BinaryIO, output_file).close()
+            else:
+                with tracer.span("mix") as span:
+                    y = mixer.mix(
+                        parts,
+                        args.gain if parts else None,
+                        args.headroom,
+                        args.block_size,
+                        ensemble,
                     )
-                    tuned_y = np.append(tuned_y, this_tuned_y)
+                    span["samples"] = len(y)
+                with tracer.span("write", samples=len(y)):
+                    write_audio(path, y, target_sr, fmt, args.block_size)
+        finally:
+            # even if the render failed, so a long-running server doesn't fill
+            # up the temporary directory
+            if mapped is not None and mapped_dir is not None:
+                # the part buffers have to go before their files can be unmapped
+                rendering.close()
+                parts = []
+                mapped.close()
+                mapped_dir.cleanup()
 
-                # print('autotuned')
 
-                # audio.save_audio(tuned_y, sr, 'tmp.wav')
+def sing(
+    args: Namespace,
+    source: str | BinaryIO | None = None,
+    output_file: BinaryIO | None = None,
+    cache: NoteCache | None = None,
+) -> None:
+    """Renders a score with the options in args. The score is read from source
+    (by default score-name.musicxml), and if output_file is given the wav is
+    streamed to it rather than to --output. A long-lived cache can be passed in to
+    use instead of opening --note-cache."""
+    check_args(args)
 
-                part_y = np.append(part_y, tuned_y)
-            else:
-                print("rest")
-                silence = audio.AudioSegment.silent(duration=int(sum(event.duration)))
-                silence.export("tmp.wav", format="wav")
-                silence_y, sr = librosa.load("tmp.wav", sr=None)
-                silence_y = librosa.resample(silence_y, orig_sr=sr, target_sr=target_sr)
-                part_y = np.append(part_y, silence_y)
-        audio.save_audio(part_y, target_sr, "tmp.wav")
-        part_audio = audio.AudioSegment.from_file("tmp.wav", format="wav")
-        if part_audio.duration_seconds > whole_audio.duration_seconds:
-            whole_audio = part_audio.overlay(whole_audio)
-        else:
-            whole_audio = whole_audio.overlay(part_audio)
-finally:
-    whole_audio.export(f"{file_name}.wav", format="wav")
+    if output_file is None and args.output == "-":
+        # keep the progress output out of the audio
+        output_file = sys.stdout.buffer
+        sys.stdout = sys.stderr
+
+    tracer.enabled = args.trace is not None or args.stats
+    tracer.take()
+
+    events, full_texts, start_ms, end_ms = load_score(args, source)
+    needed = needed_words(events)
+
+    if args.check:
+        check(events, full_texts, needed, args)
+        return
+
+    with tracer.span("tts"):
+        words_map = tts(
+            full_texts, args.tts_workers, args.tts_rate, args.tts_batch, needed
+        )
+
+    settings = render_settings(args)
+
+    pack_words(
+        words_map, words_map, settings["target_sr"], settings["resample_quality"]
+    )
+
+    if args.no_note_cache:
+        cache = None
+    elif cache is None:
+        cache = NoteCache(args.note_cache, max_bytes=args.note_cache_size << 20)
+
+    stems = StemStore(f"{args.file_name}.render") if args.incremental else None
+
+    timeline = render.Timeline(events, words_map, settings, stems, start_ms, end_ms)
+    renderer = render.NoteRenderer(args.jobs, cache)
+    timeline.schedule(renderer)
+    try:
+        write_render(args, events, timeline, renderer, output_file)
+    finally:
+        renderer.close()
+
+    if args.trace is not None:
+        tracer.write(args.trace)
+    if args.stats:
+        print(tracer.stats())
+
+
+def main() -> None:
+    sing(make_arg_parser().parse_args())
+
+
+if __name__ == "__main__":
+    main()
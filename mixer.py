@@ -0,0 +1,86 @@
+from typing import List, Sequence
+from ensemble import Ensemble
+from util import error
+import numpy as np
+
+BLOCK_SIZE = 1 << 16
+"""number of samples mixed at a time, to bound the size of temporary buffers"""
+
+LIMIT_THRESHOLD = 0.9
+"""level above which peaks are softly limited so the mix never clips"""
+
+
+def db_to_gain(db: float) -> float:
+    return 10 ** (db / 20)
+
+
+def limit(y: np.ndarray, threshold: float = LIMIT_THRESHOLD) -> np.ndarray:
+    """Soft-limits y in place: samples below threshold are left alone, and anything
+    louder is squashed smoothly so that it approaches but never reaches 1. This
+    only looks at one sample at a time, so limiting block by block gives the same
+    result as limiting the whole buffer."""
+    magnitude = np.abs(y)
+    over = magnitude > threshold
+    if np.any(over):
+        knee = 1 - threshold
+        y[over] = np.sign(y[over]) * (
+            threshold + knee * np.tanh((magnitude[over] - threshold) / knee)
+        )
+    return y
+
+
+def part_gains(
+    n_parts: int, gains_db: Sequence[float] | None, headroom_db: float
+) -> List[float]:
+    """Linear gain for each part, including the master headroom"""
+    if gains_db is None:
+        gains_db = [0.0] * n_parts
+    return [db_to_gain(db - headroom_db) for db in gains_db]
+
+
+def mix_block(
+    parts: Sequence[np.ndarray],
+    gains: Sequence[float],
+    start: int,
+    end: int,
+    ensemble: Ensemble | None = None,
+) -> np.ndarray:
+    """Mixes samples [start, end) of every part, each sung by its section of
+    ensemble if one is given. Parts shorter than end are treated as silent past
+    their end."""
+    out = np.zeros(end - start, dtype=np.float32)
+    scratch = np.empty(end - start, dtype=np.float32)
+    for i, (part, gain) in enumerate(zip(parts, gains)):
+        part_end = min(end, len(part))
+        if part_end <= start:
+            continue
+        n = part_end - start
+        y = (
+            part[start:part_end]
+            if ensemble is None
+            else ensemble.sing(i, part, start, part_end)
+        )
+        np.multiply(y, gain, out=scratch[:n])
+        out[:n] += scratch[:n]
+    return limit(out)
+
+
+def mix(
+    parts: List[np.ndarray],
+    gains_db: Sequence[float] | None = None,
+    headroom_db: float = 0.0,
+    block_size: int = BLOCK_SIZE,
+    ensemble: Ensemble | None = None,
+) -> np.ndarray:
+    """Sums float32 part buffers with a gain (in dB) for each part, leaving
+    headroom_db of headroom and limiting whatever peaks are left. This goes
+    block_size samples at a time."""
+    if gains_db is not None and len(gains_db) != len(parts):
+        error(f"expected {len(parts)} gains, got {len(gains_db)}")
+    gains = part_gains(len(parts), gains_db, headroom_db)
+    length = max((len(part) for part in parts), default=0)
+    out = np.empty(length, dtype=np.float32)
+    for start in range(0, length, block_size):
+        end = min(start + block_size, length)
+        out[start:end] = mix_block(parts, gains, start, end, ensemble)
+    return out
@@ -0,0 +1,117 @@
+from collections import OrderedDict
+from typing import Dict, Tuple
+import hashlib
+import json
+import os
+import numpy as np
+
+CACHE_VERSION = 4
+"""bump this whenever a change to the renderer changes how notes sound, so that
+stale renders aren't reused"""
+
+
+def content_key(content: Dict) -> str:
+    """A key identifying some JSON-serialisable content, for addressing the cache"""
+    content = {"version": CACHE_VERSION, **content}
+    return hashlib.sha256(
+        json.dumps(content, sort_keys=True).encode("utf-8")
+    ).hexdigest()
+
+
+def note_path(directory: str, key: str) -> str:
+    return os.path.join(directory, f"{key}.npy")
+
+
+class NoteCache:
+    """A cache of rendered notes, addressed by content_key. Recently used notes are
+    kept in memory, and every note is also saved under directory (if it isn't
+    None) so that later runs can reuse them. Both are capped in size, evicting the
+    least recently used notes first."""
+
+    def __init__(
+        self,
+        directory: str | None,
+        max_bytes: int = 1 << 30,
+        memory_max_bytes: int = 1 << 28,
+    ):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.memory_max_bytes = memory_max_bytes
+
+        self.memory: OrderedDict[str, np.ndarray] = OrderedDict()
+        self.memory_bytes = 0
+
+        self.files: Dict[str, Tuple[float, int]] = {}
+        """path -> (last used time, size) of every note on disk"""
+        self.disk_bytes = 0
+
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+            for entry in os.scandir(directory):
+                if entry.is_file() and entry.name.endswith(".npy"):
+                    stat = entry.stat()
+                    self.files[entry.path] = (stat.st_mtime, stat.st_size)
+                    self.disk_bytes += stat.st_size
+
+    def path(self, key: str) -> str:
+        return note_path(str(self.directory), key)
+
+    def get(self, key: str) -> np.ndarray | None:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return self.memory[key]
+        if self.directory is None or (path := self.path(key)) not in self.files:
+            return None
+        try:
+            y = np.load(path)
+        except (OSError, ValueError):
+            self.forget(path)
+            return None
+        os.utime(path)
+        self.files[path] = (os.path.getmtime(path), self.files[path][1])
+        self.remember(key, y)
+        return y
+
+    def put(self, key: str, y: np.ndarray) -> None:
+        self.remember(key, y)
+        if self.directory is None:
+            return
+        path = self.path(key)
+        # write to a temporary file first, so that a half-written note is never
+        # picked up by another run
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, y)
+        os.replace(tmp_path, path)
+        if path in self.files:
+            self.disk_bytes -= self.files[path][1]
+        size = os.path.getsize(path)
+        self.files[path] = (os.path.getmtime(path), size)
+        self.disk_bytes += size
+        self.evict()
+
+    def remember(self, key: str, y: np.ndarray) -> None:
+        if key in self.memory:
+            self.memory.move_to_end(key)
+            return
+        self.memory[key] = y
+        self.memory_bytes += y.nbytes
+        while self.memory_bytes > self.memory_max_bytes and len(self.memory) > 1:
+            _, evicted = self.memory.popitem(last=False)
+            self.memory_bytes -= evicted.nbytes
+
+    def forget(self, path: str) -> None:
+        if path in self.files:
+            self.disk_bytes -= self.files.pop(path)[1]
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def evict(self) -> None:
+        if self.disk_bytes <= self.max_bytes:
+            return
+        for path in sorted(self.files, key=lambda p: self.files[p][0]):
+            if self.disk_bytes <= self.max_bytes:
+                break
+            self.forget(path)
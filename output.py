@@ -0,0 +1,242 @@
+from typing import BinaryIO, TypedDict
+from util import error
+import io
+import os
+import struct
+import numpy as np
+
+FORMATS = ["wav", "flac", "opus"]
+
+EXTENSIONS = {".wav": "wav", ".flac": "flac", ".opus": "opus", ".ogg": "opus"}
+
+CONTENT_TYPES = {"wav": "audio/wav", "flac": "audio/flac", "opus": "audio/ogg"}
+
+DEPTHS = ["16", "24", "float"]
+"""bits per sample of wav and flac output; flac can't hold floats, and opus
+always encodes from floats"""
+
+DITHERS = ["none", "rectangular", "triangular"]
+"""noise added before rounding to 16 or 24 bits: none just rounds,
+rectangular adds up to half a step either way, and triangular (TPDF) adds the sum
+of two such, which also keeps the noise level from depending on the signal"""
+
+OPUS_RATES = [8000, 12000, 16000, 24000, 48000]
+
+
+class OutputFormat(TypedDict):
+    format: str
+    """one of FORMATS"""
+
+    depth: str
+    """one of DEPTHS"""
+
+    dither: str
+    """one of DITHERS"""
+
+
+def format_for_path(path: str) -> str:
+    """the format a file name implies, by its extension (wav if it doesn't)"""
+    return EXTENSIONS.get(os.path.splitext(path)[1].lower(), "wav")
+
+
+def check_format(output_format: OutputFormat, sr: int) -> None:
+    if output_format["format"] == "flac" and output_format["depth"] == "float":
+        error("flac can only be 16 or 24 bit")
+    if output_format["format"] == "opus" and sr not in OPUS_RATES:
+        error(
+            "opus needs a --sample-rate of "
+            + ", ".join(map(str, OPUS_RATES[:-1]))
+            + f" or {OPUS_RATES[-1]}"
+        )
+
+
+class Quantizer:
+    """Converts float samples to bits-bit integers, with dither. The dither noise
+    comes from a fixed seed, and is drawn in order, so converting a buffer a
+    block at a time gives the same result as converting it all at once."""
+
+    def __init__(self, bits: int, dither: str):
+        self.scale = (1 << (bits - 1)) - 1
+        self.dither = dither
+        self.rng = np.random.default_rng(0)
+
+    def __call__(self, y: np.ndarray) -> np.ndarray:
+        x = np.clip(y, -1.0, 1.0) * self.scale
+        if self.dither == "none":
+            return np.round(x).astype(np.int32)
+        # drawn a sample at a time, so blocks use up the noise in the same order
+        sources = 2 if self.dither == "triangular" else 1
+        x += self.rng.uniform(-0.5, 0.5, (len(x), sources)).sum(axis=1)
+        return np.clip(np.round(x), -self.scale - 1, self.scale).astype(np.int32)
+
+
+class WavWriter:
+    """Writes a mono wav a block at a time, as 16 or 24 bit integers or 32 bit
+    floats. The header is written up front from n_frames, so the output can go to
+    a pipe; if fewer frames than that end up being written, close fixes up the
+    header where the file allows it."""
+
+    def __init__(
+        self,
+        file: BinaryIO,
+        sr: int,
+        n_frames: int,
+        depth: str = "16",
+        dither: str = "none",
+    ):
+        self.file = file
+        self.sr = sr
+        self.n_frames = n_frames
+        self.depth = depth
+        self.sample_width = 4 if depth == "float" else int(depth) // 8
+        self.quantize = None if depth == "float" else Quantizer(int(depth), dither)
+        self.frames_written = 0
+        self.write_header(n_frames)
+
+    def write_header(self, n_frames: int) -> None:
+        data_size = n_frames * self.sample_width
+        fmt = struct.pack(
+            "<HHIIHH",
+            3 if self.depth == "float" else 1,
+            1,
+            self.sr,
+            self.sr * self.sample_width,
+            self.sample_width,
+            self.sample_width * 8,
+        )
+        # files of floats need a fact chunk, with the number of frames
+        fact = (
+            b"fact" + struct.pack("<II", 4, n_frames) if self.depth == "float" else b""
+        )
+        self.file.write(
+            b"RIFF"
+            + struct.pack("<I", 4 + 8 + len(fmt) + len(fact) + 8 + data_size)
+            + b"WAVEfmt "
+            + struct.pack("<I", len(fmt))
+            + fmt
+            + fact
+            + b"data"
+            + struct.pack("<I", data_size)
+        )
+
+    def write(self, y: np.ndarray) -> None:
+        if self.quantize is None:
+            data = np.asarray(y, dtype="<f4").tobytes()
+        elif self.depth == "16":
+            data = self.quantize(y).astype("<i2").tobytes()
+        else:
+            # the low three bytes of each little-endian int32
+            data = (
+                self.quantize(y).astype("<i4").view(np.uint8).reshape(-1, 4)[:, :3]
+            ).tobytes()
+        self.file.write(data)
+        self.frames_written += len(y)
+        self.file.flush()
+
+    def close(self) -> None:
+        if self.frames_written != self.n_frames and self.file.seekable():
+            self.file.seek(0)
+            self.write_header(self.frames_written)
+        self.file.flush()
+
+
+class PipeFile(io.RawIOBase):
+    """Lets libsndfile write to a file that can't seek, by keeping count of the
+    position and allowing the seeks that don't go anywhere (which is all the ogg
+    encoder does)"""
+
+    def __init__(self, file: BinaryIO):
+        self.file = file
+        self.position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self.file.write(data)
+        self.position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if offset != (self.position if whence == io.SEEK_SET else 0):
+            raise io.UnsupportedOperation("seek")
+        return self.position
+
+    def flush(self) -> None:
+        self.file.flush()
+
+
+class SoundFileWriter:
+    """Encodes flac or opus a block at a time, in process with libsndfile"""
+
+    def __init__(self, file: BinaryIO, sr: int, output_format: OutputFormat):
+        # imported here, as most renders are written as wav
+        import soundfile
+
+        self.quantize: Quantizer | None = None
+        self.shift = 0
+        if output_format["format"] == "opus":
+            format, subtype = "OGG", "OPUS"
+        else:
+            if not file.seekable():
+                # flac's header, which says how long the stream is, goes in last
+                error("flac can't be written to a pipe; use wav or opus")
+            depth = output_format["depth"]
+            format, subtype = "FLAC", f"PCM_{depth}"
+            self.quantize = Quantizer(int(depth), output_format["dither"])
+            # libsndfile takes the top 24 bits of an int32
+            self.shift = 8 if depth == "24" else 0
+        self.sound_file = soundfile.SoundFile(
+            file if file.seekable() else PipeFile(file),
+            "w",
+            sr,
+            1,
+            subtype,
+            format=format,
+        )
+
+    def write(self, y: np.ndarray) -> None:
+        if self.quantize is None:
+            self.sound_file.write(np.clip(y, -1.0, 1.0).astype(np.float32))
+        elif self.shift:
+            self.sound_file.write(self.quantize(y) << self.shift)
+        else:
+            self.sound_file.write(self.quantize(y).astype(np.int16))
+
+    def close(self) -> None:
+        self.sound_file.close()
+
+
+def open_writer(
+    file: BinaryIO, sr: int, n_frames: int, output_format: OutputFormat
+) -> WavWriter | SoundFileWriter:
+    """A writer of output_format to file, which samples can be written to a block
+    at a time"""
+    if output_format["format"] == "wav":
+        return WavWriter(
+            file, sr, n_frames, output_format["depth"], output_format["dither"]
+        )
+    return SoundFileWriter(file, sr, output_format)
+
+
+def write_audio(
+    file_name: str,
+    y: np.ndarray,
+    sr: int,
+    output_format: OutputFormat,
+    block_size: int = 1 << 16,
+) -> None:
+    """Encodes y block_size samples at a time, so that converting it doesn't need
+    copies as long as the whole of it"""
+    with open(file_name, "wb") as file:
+        writer = open_writer(file, sr, len(y), output_format)
+        for start in range(0, len(y), block_size):
+            writer.write(y[start : start + block_size])
+        writer.close()
+
+
+def write_wav(file_name: str, y: np.ndarray, sr: int) -> None:
+    write_audio(file_name, y, sr, {"format": "wav", "depth": "16", "dither": "none"})
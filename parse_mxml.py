@@ -1,21 +1,30 @@
-from util import not_none, error
-from typing import Dict, List, cast
+from util import not_none, error, strip_word
+from typing import BinaryIO, Dict, List, Tuple, cast
+from array import array
+import io
 import xml.etree.ElementTree as ET
+import numpy as np
 
 """Some sort of note event"""
 
 
 class Note:
-    def __init__(self, *, duration: List[float]):
+    def __init__(self, *, duration: List[float], onset: float = 0, measure: str = ""):
         self.duration: List[float] = duration
         """durations, in milliseconds"""
 
+        self.onset: float = onset
+        """start time from the beginning of the part, in milliseconds"""
+
+        self.measure: str = measure
+        """number of the measure this starts in"""
+
 
 class Rest(Note):
     """A rest; silence"""
 
-    def __init__(self, *, duration: float):
-        super().__init__(duration=[duration])
+    def __init__(self, *, duration: float, onset: float = 0, measure: str = ""):
+        super().__init__(duration=[duration], onset=onset, measure=measure)
 
     def __str__(self):
         return f"rest for {self.duration[0]}ms"
@@ -32,8 +41,10 @@ class Pitch(Note):
         octave: List[int],
         lyric: str | None,
         lyric_pos: int | None,
+        onset: float = 0,
+        measure: str = "",
     ):
-        super().__init__(duration=duration)
+        super().__init__(duration=duration, onset=onset, measure=measure)
 
         self.degree: List[int] = degree
         """degree of the chromatuc scale (A=0, Bb=11)"""
@@ -71,132 +82,487 @@ class Pitch(Note):
         return f'\'{"-" if self.lyric_pos in [1, 2] else ""}{self.lyric if self.lyric else "_"}\'{"-" if self.lyric_pos in [0, 1] else ""} @ {pitch}{self.octave} for {self.duration}ms'
 
 
-def events_from_mxml(
-    xml_txt: str, part_names: List[str], file_name: str
-) -> Dict[str, List[Note]]:
-    try:
-        xml = ET.fromstring(xml_txt)
-    except:
-        error(f"couldn't parse {file_name} as XML")
+DEFAULT_TEMPO = 126
+"""tempo (in bpm) until the score sets one"""
 
-    if xml.tag != "score-partwise":
-        error("expected root element to be score-partwise")
-    if xml.get("version") != "4.0":
-        error("expected version to be 4.0")
-    part_list = xml.find("part-list")
-    if part_list is None:
-        error("couldn't find part-list")
-    part_ids = list(
-        map(
-            lambda p: p.get("id"),
-            filter(
-                lambda p: (n := p.find("part-name")) is not None
-                and n.text in part_names,
-                part_list.iter("score-part"),
-            ),
+
+class TempoMap:
+    """The tempo over the course of a score, for converting between beats
+    (crotchets from the start of the score) and milliseconds. Tempo changes are
+    looked up by binary search, so converting doesn't depend on where in the
+    score a time is."""
+
+    def __init__(self, changes: List[Tuple[float, float]]):
+        """changes are (beat, bpm) pairs, sorted by beat. A change at the same beat
+        as an earlier one replaces it."""
+        beats = [0.0]
+        tempos = [float(DEFAULT_TEMPO)]
+        for beat, tempo in changes:
+            if beat == beats[-1]:
+                tempos[-1] = tempo
+            else:
+                beats.append(beat)
+                tempos.append(tempo)
+        self.beats = np.array(beats)
+        self.tempos = np.array(tempos)
+        self.ms = np.concatenate(
+            [[0.0], np.cumsum(np.diff(self.beats) * 60000 / self.tempos[:-1])]
         )
-    )
-    if len(part_names) != len(part_ids):
-        error(
-            "couldn't find some parts - make sure they are spelled correctly, unabbreviated, using correct capitalisation, and enclosed in 'quotation marks' if needed"
+        """time of each tempo change"""
+
+    def change_at(self, beat: np.ndarray | float) -> np.ndarray:
+        """index of the tempo change in effect at each beat"""
+        return np.searchsorted(self.beats, beat, side="right") - 1
+
+    def tempo_at(self, beat: np.ndarray | float) -> np.ndarray:
+        return self.tempos[self.change_at(beat)]
+
+    def to_ms(self, beat: np.ndarray | float) -> np.ndarray:
+        i = self.change_at(beat)
+        return self.ms[i] + (beat - self.beats[i]) * 60000 / self.tempos[i]
+
+
+class EventTable:
+    """A part's events as a struct of arrays, rather than one object per event.
+    Event i covers segments seg_offset[i] to seg_offset[i + 1] (a pitch has one
+    segment per tied note or melisma note; a rest has one).
+
+    Positions are parsed in beats; the times in ms are filled in by apply_tempo
+    once the whole score's tempo map is known."""
+
+    def __init__(self) -> None:
+        self.onset_beat = array("d")
+        """start of each event, in beats from the beginning of the part"""
+        self.onset = array("d")
+        """start time of each event from the beginning of the part, in ms"""
+        self.is_rest = array("b")
+        self.lyric = array("l")
+        """index into lyrics of each event's syllable; -1 if it has none"""
+        self.lyric_pos = array("b")
+        """position of each event's lyric (see Pitch.lyric_pos); -1 if none"""
+        self.measure = array("l")
+        """index into measures of the measure each event starts in"""
+        self.seg_offset = array("q", [0])
+
+        self.seg_start_beat = array("d")
+        self.seg_beats = array("d")
+        """length of each segment, in beats"""
+        self.seg_duration = array("d")
+        """duration of each segment, in ms"""
+        self.seg_degree = array("b")
+        self.seg_octave = array("b")
+
+        self.lyrics: List[str] = []
+        self.lyric_word = array("l")
+        """index into words of the word each event's syllable is part of; -1 if
+        none (filled in by join_lyrics, as are the positions)"""
+        self.lyric_start_pos = array("l")
+        self.lyric_end_pos = array("l")
+        self.words: List[str] = []
+        self.measures: List[str] = []
+        self.measure_beats = array("d")
+        """where each measure starts, in beats"""
+
+    def __len__(self) -> int:
+        return len(self.onset_beat)
+
+    def add_event(
+        self,
+        onset: float,
+        is_rest: bool,
+        lyric: str | None,
+        lyric_pos: int | None,
+        measure: int,
+    ) -> None:
+        """adds an event starting at onset (in beats)"""
+        self.onset_beat.append(onset)
+        self.is_rest.append(is_rest)
+        if lyric is None:
+            self.lyric.append(-1)
+        else:
+            self.lyric.append(len(self.lyrics))
+            self.lyrics.append(lyric)
+        self.lyric_pos.append(-1 if lyric_pos is None else lyric_pos)
+        self.measure.append(measure)
+        self.seg_offset.append(self.seg_offset[-1])
+
+    def add_segment(
+        self, start: float, beats: float, degree: int = 0, octave: int = 0
+    ) -> None:
+        """adds a segment (starting at start and lasting beats) to the last event"""
+        self.seg_start_beat.append(start)
+        self.seg_beats.append(beats)
+        self.seg_degree.append(degree)
+        self.seg_octave.append(octave)
+        self.seg_offset[-1] += 1
+
+    def apply_tempo(self, tempo_map: TempoMap) -> None:
+        self.onset = array("d", tempo_map.to_ms(np.array(self.onset_beat)))
+        # tempo only changes at the start of a measure, so no segment spans a
+        # change and each can be converted at a single tempo
+        self.seg_duration = array(
+            "d",
+            np.array(self.seg_beats)
+            * 60000
+            / tempo_map.tempo_at(np.array(self.seg_start_beat)),
+        )
+
+    def arrays(self) -> Dict[str, np.ndarray]:
+        """zero-copy NumPy views of every column"""
+        return {
+            name: np.frombuffer(getattr(self, name), dtype=getattr(self, name).typecode)
+            for name in [
+                "onset_beat",
+                "onset",
+                "is_rest",
+                "lyric",
+                "lyric_pos",
+                "measure",
+                "seg_offset",
+                "seg_start_beat",
+                "seg_beats",
+                "seg_duration",
+                "seg_degree",
+                "seg_octave",
+            ]
+        }
+
+    def durations(self) -> np.ndarray:
+        """total duration of each event, in ms"""
+        if not len(self):
+            return np.zeros(0)
+        arrays = self.arrays()
+        return np.add.reduceat(arrays["seg_duration"], arrays["seg_offset"][:-1])
+
+    def end_time(self) -> float:
+        """when the last event ends, in ms"""
+        return float(self.onset[-1] + self.durations()[-1]) if len(self) else 0
+
+    def overlapping(self, start: float, end: float) -> range:
+        """indices of the events that overlap start to end (in ms). A part's events
+        don't overlap each other, so both their onsets and their ends are sorted
+        and can be binary searched."""
+        onsets = self.arrays()["onset"]
+        ends = onsets + self.durations()
+        return range(
+            int(np.searchsorted(ends, start, side="right")),
+            int(np.searchsorted(onsets, end, side="left")),
         )
-    print(part_ids)
-
-    events: Dict[str, List[Note]] = {}
-
-    tempo = 126  # in bpm
-
-    # note represented as { degree: int, octave: int }; degree is from 0 (A) to 11 (Bb)
-    for part in filter(lambda p: p.get("id") in part_ids, xml.iter("part")):
-        part_id = part.get("id") or error("couldn't find part id")
-        events[cast(str, part_id)] = []
-        divisions = None
-        octave_change = -1
-        for measure in part.iter("measure"):
-            attrs = measure.find("attributes")
-            division = attrs.find("divisions") if attrs is not None else None
-            clef = attrs.find("clef") if attrs is not None else None
-            octave_change_el = (
-                clef.find("clef-octave-change") if clef is not None else None
+
+    def join_lyrics(self) -> List[str]:
+        """Joins the syllables into words, noting which word each event is part of
+        and which of its characters the event's syllable is. Returns the words."""
+        n = len(self)
+        self.lyric_word = array("l", [-1]) * n
+        self.lyric_start_pos = array("l", [0]) * n
+        self.lyric_end_pos = array("l", [0]) * n
+        words: List[str] = []
+        curr_word_start_idx = 0
+        prev_ev_idx = 0
+        for i in range(n):
+            if self.is_rest[i]:
+                continue
+            if self.lyric[i] >= 0:
+                lyric = strip_word(self.lyrics[self.lyric[i]])
+                match self.lyric_pos[i]:
+                    case 0:
+                        words.append(lyric)
+                        curr_word_start_idx = i
+                        self.lyric_start_pos[i] = 0
+                    case 3:
+                        words.append(lyric)
+                        self.lyric_word[i] = len(words) - 1
+                        self.lyric_start_pos[i] = 0
+                    case 1 | 2:
+                        words[-1] += lyric
+                        self.lyric_start_pos[i] = self.lyric_end_pos[prev_ev_idx] + 1
+                        if self.lyric_pos[i] == 2:
+                            for j in range(curr_word_start_idx, i + 1):
+                                self.lyric_word[j] = len(words) - 1
+                if self.lyric_pos[i] in (0, 1, 2, 3):
+                    self.lyric_end_pos[i] = self.lyric_start_pos[i] + len(lyric) - 1
+            prev_ev_idx = i
+        self.words = words
+        return words
+
+    def empty_lyrics(self) -> bool:
+        """whether any pitch has no lyric"""
+        return any(
+            not self.is_rest[i]
+            and (self.lyric[i] < 0 or self.lyrics[self.lyric[i]] == "")
+            for i in range(len(self))
+        )
+
+    def note(self, i: int) -> Note:
+        segments = slice(self.seg_offset[i], self.seg_offset[i + 1])
+        measure = self.measures[self.measure[i]]
+        if self.is_rest[i]:
+            return Rest(
+                duration=self.seg_duration[segments][0],
+                onset=self.onset[i],
+                measure=measure,
             )
-            # if octave_change_el is not None:
-            #     octave_change_text = octave_change_el.text
-            #     if octave_change_text == '':
-            #         octave_change = 0
-            #     elif octave_change_text is not None:
-            #         octave_change = int(octave_change_text)
-            if divisions is not None and division is not None:
-                error("divisions redefined for a part")
-            if divisions is None and division is None:
-                error("missing divisions for a part")
-            if division is not None:
-                divisions = int(division.text or error("missing divisions"))
-            # " The <divisions> element indicates how many divisions per quarter note [crotchet] are used to indicate a note's duration."
-            for direction in measure.iter("direction"):
-                sound = direction.find("sound")
-                if sound is not None:
-                    tempo_val = sound.get("tempo")
-                    if tempo_val is not None:
-                        tempo = int(tempo_val)
-            for note in measure.iter("note"):
-                duration = (
-                    int(not_none((note.find("duration"))).text or error("text is None"))
-                    / divisions
-                    * 60000
-                    / tempo
-                )
-                if note.find("rest") is not None:
-                    events[part_id].append(Rest(duration=duration))
-                elif (pitch := note.find("pitch")) is not None:
-                    alter = (
-                        int(cast(str, a.text))
-                        if (a := pitch.find("alter")) is not None
-                        else 0
-                    )
-                    degree = (
-                        {"A": 0, "B": 2, "C": 3, "D": 5, "E": 7, "F": 8, "G": 10}[
-                            cast(str, not_none(pitch.find("step")).text)
-                        ]
-                        + alter
-                    ) % 12
-                    octave = (
-                        int(
-                            not_none(pitch.find("octave")).text
-                            or error("no octave text")
+        pitch = Pitch(
+            degree=list(self.seg_degree[segments]),
+            octave=list(self.seg_octave[segments]),
+            lyric=self.lyrics[self.lyric[i]] if self.lyric[i] >= 0 else None,
+            lyric_pos=self.lyric_pos[i] if self.lyric_pos[i] >= 0 else None,
+            duration=list(self.seg_duration[segments]),
+            onset=self.onset[i],
+            measure=measure,
+        )
+        if self.lyric_word:
+            if self.lyric_word[i] >= 0:
+                pitch.lyric_word = self.words[self.lyric_word[i]]
+            pitch.lyric_start_pos = self.lyric_start_pos[i]
+            pitch.lyric_end_pos = self.lyric_end_pos[i]
+        return pitch
+
+    def to_notes(self, indices: range | None = None) -> List[Note]:
+        """Note objects for the events at indices (by default, all of them), with
+        their words if join_lyrics has been called"""
+        return [
+            self.note(i) for i in (range(len(self)) if indices is None else indices)
+        ]
+
+
+class Score:
+    """The parsed parts of a score, along with its tempo map and an index of
+    where each measure starts"""
+
+    def __init__(
+        self,
+        parts: Dict[str, EventTable],
+        tempo_map: TempoMap,
+        measures: List[str],
+        measure_beats: np.ndarray,
+    ):
+        self.parts = parts
+        self.tempo_map = tempo_map
+        self.measures = measures
+        """number of each measure, in order"""
+
+        self.measure_beats = measure_beats
+        """where each measure starts, in beats, followed by where the last ends"""
+
+    def end_time(self) -> float:
+        """the length of the longest part, in milliseconds"""
+        return max((table.end_time() for table in self.parts.values()), default=0)
+
+    def measure_span(self, first: str, last: str) -> Tuple[float, float]:
+        """start and end (in ms) of measures first to last inclusive"""
+        for number in [first, last]:
+            if number not in self.measures:
+                error(f"couldn't find measure {number}")
+        start = self.measures.index(first)
+        end = self.measures.index(last) + 1
+        if end <= start:
+            error(f"measure {last} comes before measure {first}")
+        return (
+            float(self.tempo_map.to_ms(self.measure_beats[start])),
+            float(self.tempo_map.to_ms(self.measure_beats[end])),
+        )
+
+
+def score_from_mxml(
+    source: str | BinaryIO, part_names: List[str], file_name: str
+) -> Score:
+    """Parses the given parts of a MusicXML file (a path or a binary file) into an
+    EventTable each. The file is streamed a measure at a time, and each measure is
+    thrown away once its events are in the table, so memory use only depends on
+    the number of events, not the size of the document.
+
+    Tempo markings are collected from every part (not just the ones asked for)
+    into a tempo map, which applies to the whole score. A tempo marking applies
+    from the start of the measure it's in."""
+    events: Dict[str, EventTable] = {}
+    part_ids: List[str] = []
+    part_id_names: Dict[str, str] = {}
+
+    tempos: Dict[str, int] = {}
+    """tempo (in bpm) set in each measure that sets one, by measure number"""
+
+    root: ET.Element | None = None
+    part_id: str | None = None
+    divisions = None
+    octave_change = -1
+    beat = 0.0
+
+    try:
+        for event, el in ET.iterparse(source, events=("start", "end")):
+            if root is None:
+                root = el
+                if root.tag != "score-partwise":
+                    error("expected root element to be score-partwise")
+                if root.get("version") != "4.0":
+                    error("expected version to be 4.0")
+                continue
+            if event == "start":
+                if el.tag == "part":
+                    part_id = el.get("id") or error("couldn't find part id")
+                    if part_id in part_ids:
+                        events[part_id] = EventTable()
+                    divisions = None
+                    octave_change = -1
+                    beat = 0.0
+                continue
+
+            if el.tag == "part-list":
+                for score_part in el.iter("score-part"):
+                    if (n := score_part.find("part-name")) is not None:
+                        part_id_names[cast(str, score_part.get("id"))] = cast(
+                            str, n.text
                         )
-                        + octave_change
+                part_ids = [
+                    part_id
+                    for part_id, name in part_id_names.items()
+                    if name in part_names
+                ]
+                if len(part_names) != len(part_ids):
+                    error(
+                        "couldn't find some parts - make sure they are spelled correctly, unabbreviated, using correct capitalisation, and enclosed in 'quotation marks' if needed"
                     )
-                    lyrics = note.find("lyric")
-                    if lyrics is not None:
-                        lyric: str = not_none((not_none(lyrics.find("text"))).text)
-                        lyric_pos: int = not_none(
-                            [
-                                "begin",
-                                "middle",
-                                "end",
-                                "single",
-                            ].index(
-                                not_none((lyrics.find("syllabic"))).text
-                                or error("no syllabic text")
-                            )
+                print(part_ids)
+            elif el.tag == "part":
+                if part_id in events:
+                    events[part_id].measure_beats.append(beat)
+                part_id = None
+                root.remove(el)
+            elif el.tag == "measure" and part_id is not None:
+                measure = el
+                for direction in measure.iter("direction"):
+                    sound = direction.find("sound")
+                    if sound is not None:
+                        tempo_val = sound.get("tempo")
+                        if tempo_val is not None:
+                            tempos[measure.get("number", "")] = int(tempo_val)
+                if part_id not in events:
+                    el.clear()
+                    continue
+                table = events[part_id]
+                measure_index = len(table.measures)
+                table.measures.append(measure.get("number", ""))
+                table.measure_beats.append(beat)
+                attrs = measure.find("attributes")
+                division = attrs.find("divisions") if attrs is not None else None
+                clef = attrs.find("clef") if attrs is not None else None
+                octave_change_el = (
+                    clef.find("clef-octave-change") if clef is not None else None
+                )
+                # if octave_change_el is not None:
+                #     octave_change_text = octave_change_el.text
+                #     if octave_change_text == '':
+                #         octave_change = 0
+                #     elif octave_change_text is not None:
+                #         octave_change = int(octave_change_text)
+                if divisions is not None and division is not None:
+                    error("divisions redefined for a part")
+                if divisions is None and division is None:
+                    error("missing divisions for a part")
+                if division is not None:
+                    divisions = int(division.text or error("missing divisions"))
+                # " The <divisions> element indicates how many divisions per quarter note [crotchet] are used to indicate a note's duration."
+                for note in measure.iter("note"):
+                    beats = int(
+                        not_none((note.find("duration"))).text or error("text is None")
+                    ) / cast(int, divisions)
+                    note_beat = beat
+                    beat += beats
+                    if note.find("rest") is not None:
+                        table.add_event(note_beat, True, None, None, measure_index)
+                        table.add_segment(note_beat, beats)
+                    elif (pitch := note.find("pitch")) is not None:
+                        alter = (
+                            int(cast(str, a.text))
+                            if (a := pitch.find("alter")) is not None
+                            else 0
                         )
-                        events[part_id].append(
-                            Pitch(
-                                degree=[degree],
-                                octave=[octave],
-                                lyric=lyric,
-                                lyric_pos=lyric_pos,
-                                duration=[duration],
+                        degree = (
+                            {"A": 0, "B": 2, "C": 3, "D": 5, "E": 7, "F": 8, "G": 10}[
+                                cast(str, not_none(pitch.find("step")).text)
+                            ]
+                            + alter
+                        ) % 12
+                        octave = (
+                            int(
+                                not_none(pitch.find("octave")).text
+                                or error("no octave text")
                             )
+                            + octave_change
                         )
-                    else:
-                        prev_event = events[part_id][-1]
-                        if not isinstance(prev_event, Pitch):
+                        lyrics = note.find("lyric")
+                        if lyrics is not None:
+                            lyric: str = not_none((not_none(lyrics.find("text"))).text)
+                            lyric_pos: int = not_none(
+                                [
+                                    "begin",
+                                    "middle",
+                                    "end",
+                                    "single",
+                                ].index(
+                                    not_none((lyrics.find("syllabic"))).text
+                                    or error("no syllabic text")
+                                )
+                            )
+                            table.add_event(
+                                note_beat, False, lyric, lyric_pos, measure_index
+                            )
+                        elif not len(table) or table.is_rest[-1]:
                             error(
                                 f"previous event wasn't a pitch (in measure {measure.get('number')})"
                             )
-                        prev_event.duration.append(duration)
-                        prev_event.degree.append(degree)
-                        prev_event.octave.append(octave)
+                        table.add_segment(note_beat, beats, degree, octave)
+                el.clear()
+    except ET.ParseError:
+        error(f"couldn't parse {file_name} as XML")
+    except OSError:
+        error(f"couldn't read file {file_name}.musicxml")
+
+    if root is None:
+        error(f"couldn't parse {file_name} as XML")
+    if not part_id_names:
+        error("couldn't find part-list")
+
+    # in the order the parts were asked for, rather than the order of the score
+    parts = {
+        part_id: events[part_id]
+        for part_id in sorted(
+            events, key=lambda part_id: part_names.index(part_id_names[part_id])
+        )
+    }
+
+    # every part has the same measures, so any of them can be the index
+    index = max(parts.values(), key=lambda table: len(table.measures), default=None)
+    measures = index.measures if index is not None else []
+    measure_beats = np.array(index.measure_beats if index is not None else [0.0])
+
+    tempo_map = TempoMap(
+        sorted(
+            (float(measure_beats[measures.index(number)]), tempo)
+            for number, tempo in tempos.items()
+            if number in measures
+        )
+    )
+    for table in parts.values():
+        table.apply_tempo(tempo_map)
+
+    return Score(parts, tempo_map, measures, measure_beats)
+
+
+def events_from_mxml(
+    xml_txt: str, part_names: List[str], file_name: str
+) -> Dict[str, List[Note]]:
+    return {
+        part_id: table.to_notes()
+        for part_id, table in score_from_mxml(
+            io.BytesIO(xml_txt.encode("utf-8")), part_names, file_name
+        ).parts.items()
+    }
 
-    return events
+
+def total_duration(events: Dict[str, List[Note]]) -> float:
+    """the length of the longest part, in milliseconds"""
+    return max(
+        (evs[-1].onset + sum(evs[-1].duration) for evs in events.values() if evs),
+        default=0,
+    )
@@ -0,0 +1,558 @@
+from typing import (
+    Callable,
+    Deque,
+    Dict,
+    Generator,
+    Iterator,
+    List,
+    Set,
+    Tuple,
+    TypedDict,
+    cast,
+)
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from util import error, ms_to_samples, s_to_ms, strip_word
+from parse_mxml import Note, Pitch, total_duration
+from tts import VOICE_ID, WordInfo, audio_digest
+from note_cache import NoteCache, content_key
+from word_pack import open_pack, pack_dir
+from word_analysis import load_analysis
+from stems import MeasureSegment, StemStore
+from tracing import TraceEvent, tracer
+import numpy as np
+
+NOTE_NAMES = ["A", "Bb", "B", "C", "C#", "D", "Eb", "E", "F", "F#", "G", "Ab"]
+
+ENGINES = ["vocoder", "rubberband"]
+"""vocoder: stretch with rubberband, then tune with audio.adjust_pitch
+rubberband: stretch and tune in a single rubberband pass"""
+
+RESAMPLE_QUALITIES = ["soxr_vhq", "soxr_hq", "soxr_mq", "soxr_lq", "soxr_qq"]
+"""librosa res_types that words can be resampled with, from best to fastest"""
+
+
+class RenderSettings(TypedDict):
+    """Settings that affect how a note sounds"""
+
+    target_sr: int
+    """the working sample rate: words are resampled to this once, when they go
+    into the word pack, and everything after that is at this rate"""
+
+    engine: str
+    resample_quality: str
+    """one of RESAMPLE_QUALITIES"""
+
+
+class NoteJob(TypedDict):
+    """Everything needed to render one pitched note, independent of any other note"""
+
+    word: str
+    audio_digest: str
+    """tts.audio_digest of the word, so that a word fetched again isn't sung from
+    notes rendered from its old audio"""
+
+    lyric_start_pos: int
+    lyric_end_pos: int
+    pack_dir: str
+    start_ms: int
+    end_ms: int
+    onset: float
+    duration: List[float]
+    degree: List[int]
+    octave: List[int]
+    settings: RenderSettings
+
+
+def note_job(
+    event: Pitch, words_map: Dict[str, WordInfo], settings: RenderSettings
+) -> NoteJob:
+    if (word := strip_word(event.lyric_word)) not in words_map:
+        error(f'"{word}" not registered')
+
+    word_info = words_map[word]
+
+    return {
+        "word": word,
+        "audio_digest": audio_digest(word),
+        "lyric_start_pos": event.lyric_start_pos,
+        "lyric_end_pos": event.lyric_end_pos,
+        "pack_dir": pack_dir(settings["target_sr"], settings["resample_quality"]),
+        "start_ms": s_to_ms(word_info["character_start_times"][event.lyric_start_pos]),
+        "end_ms": s_to_ms(word_info["character_end_times"][event.lyric_end_pos]),
+        "onset": event.onset,
+        "duration": event.duration,
+        "degree": event.degree,
+        "octave": event.octave,
+        "settings": settings,
+    }
+
+
+def segment_bounds(onset: float, duration: List[float], sr: int) -> np.ndarray:
+    """Sample offsets of each tied segment's boundaries relative to the start of the
+    note. These are rounded from absolute times, so that rounding errors don't
+    accumulate over the course of a part."""
+    start = ms_to_samples(onset, sr)
+    ends = onset + np.cumsum([0.0] + duration)
+    return np.array([ms_to_samples(end, sr) - start for end in ends])
+
+
+def note_key(job: NoteJob) -> str:
+    """A key for the note cache, covering everything that affects how the note
+    sounds. The onset only matters through how it rounds the segment boundaries,
+    so the same note at a different time usually has the same key."""
+    return content_key(
+        {
+            "voice": VOICE_ID,
+            "word": job["word"],
+            "audio": job["audio_digest"],
+            "lyric_start_pos": job["lyric_start_pos"],
+            "lyric_end_pos": job["lyric_end_pos"],
+            "start_ms": job["start_ms"],
+            "end_ms": job["end_ms"],
+            "bounds": segment_bounds(
+                job["onset"], job["duration"], job["settings"]["target_sr"]
+            ).tolist(),
+            "degree": job["degree"],
+            "octave": job["octave"],
+            "settings": job["settings"],
+        }
+    )
+
+
+def cached_render_note(job: NoteJob, key: str, cache: NoteCache | None) -> np.ndarray:
+    if cache is not None and (y := cache.get(key)) is not None:
+        return y
+    y = render_note(job)
+    if cache is not None:
+        cache.put(key, y)
+    return y
+
+
+def frame_targets(
+    bounds: np.ndarray, target_pitches: np.ndarray, frame_positions: np.ndarray
+) -> np.ndarray:
+    """The target pitch at each frame, given each frame's position in the note"""
+    segments = np.searchsorted(bounds, frame_positions, side="right") - 1
+    return target_pitches[np.clip(segments, 0, len(target_pitches) - 1)]
+
+
+def render_note(job: NoteJob) -> np.ndarray:
+    """Renders a single (possibly tied or melismatic) note. This only depends on
+    its arguments, so it can be run in a worker process. The result is exactly as
+    many samples long as the note occupies on the part's timeline."""
+    # imported here rather than at the top, so that main.py starts quickly
+    import audio
+    import librosa
+
+    target_sr = job["settings"]["target_sr"]
+    duration = job["duration"]
+    bounds = segment_bounds(job["onset"], duration, target_sr)
+
+    if (analysis := load_analysis(job["word"], job["audio_digest"])) is None:
+        error(f"\"{job['word']}\" hasn't been analysed")
+    # the silence either side of the syllable was found when the word was packed
+    trim_start, trim_end = analysis.trimmed(
+        job["lyric_start_pos"], job["lyric_end_pos"]
+    )
+
+    # the pack holds the word already decoded at target_sr
+    with tracer.span("crop", word=job["word"]) as span:
+        y = open_pack(job["pack_dir"], target_sr).get(job["word"], job["audio_digest"])[
+            max(
+                ms_to_samples(trim_start * 1000, target_sr),
+                ms_to_samples(job["start_ms"], target_sr),
+            ) : min(
+                ms_to_samples(trim_end * 1000, target_sr),
+                ms_to_samples(job["end_ms"], target_sr),
+            )
+        ]
+        span["samples"] = len(y)
+
+    target_pitches = np.array(
+        [
+            librosa.note_to_hz(f"{NOTE_NAMES[degree]}{octave}")
+            for degree, octave in zip(job["degree"], job["octave"])
+        ]
+    )
+
+    if job["settings"]["engine"] == "rubberband":
+        # stretching doesn't change pitch, so the unstretched syllable's contour
+        # can be mapped straight onto the output timeline
+        contour = analysis.contour(trim_start, trim_end, len(y), target_sr)
+        frame_positions = (
+            np.arange(len(contour.f0)) * contour.hop_length * bounds[-1] / len(y)
+        )
+        ratios = audio.correction_ratios(
+            contour, frame_targets(bounds, target_pitches, frame_positions)
+        )
+        with tracer.span(
+            "stretch and shift", word=job["word"], samples=int(bounds[-1])
+        ):
+            return librosa.util.fix_length(
+                audio.stretch_and_shift_audio(
+                    y, target_sr, bounds[-1], ratios, contour.hop_length
+                ),
+                size=bounds[-1],
+            )
+
+    with tracer.span("stretch", word=job["word"], samples=int(bounds[-1])):
+        stretched_y, sr = audio.stretch_audio(
+            y, float(target_sr), bounds[-1] / target_sr
+        )
+    # rubberband keeps the sample rate, so this is normally a no-op
+    with tracer.span("resample", word=job["word"], samples=int(bounds[-1])):
+        stretched_y = librosa.util.fix_length(
+            audio.resample(
+                stretched_y, sr, target_sr, job["settings"]["resample_quality"]
+            ),
+            size=bounds[-1],
+        )
+
+    # the pitch of the whole syllable, from the word's analysis, and tune every
+    # segment from that
+    contour = analysis.contour(trim_start, trim_end, int(bounds[-1]), target_sr)
+    frame_positions = np.arange(len(contour.f0)) * contour.hop_length
+    with tracer.span("pitch shift", word=job["word"], samples=int(bounds[-1])):
+        tuned_y, sr = audio.adjust_pitch(
+            stretched_y,
+            float(target_sr),
+            frame_targets(bounds, target_pitches, frame_positions),
+            contour,
+        )
+
+    return tuned_y
+
+
+def traced_render_note(
+    job: NoteJob, trace: bool
+) -> Tuple[np.ndarray, List[TraceEvent]]:
+    """render_note for a worker process, sending back the spans it recorded"""
+    tracer.enabled = trace
+    # forked workers start with a copy of the parent's spans, which aren't theirs
+    tracer.take()
+    return render_note(job), tracer.take()
+
+
+def measure_segments(
+    evs: List[Note], keys: List[str | None], target_sr: int
+) -> List[Tuple[MeasureSegment, List[int]]]:
+    """Groups a part's events by the measure they start in, with a hash of each
+    group's content and the indices of its events. The hash covers the note keys
+    (so pitches, durations, lyrics and render settings) and the rest lengths, but
+    not where the measure starts, so a measure that has only moved can be reused."""
+    groups: List[Tuple[str, List[int]]] = []
+    for i, event in enumerate(evs):
+        if groups and groups[-1][0] == event.measure:
+            groups[-1][1].append(i)
+        else:
+            groups.append((event.measure, [i]))
+
+    segments: List[Tuple[MeasureSegment, List[int]]] = []
+    for measure, indices in groups:
+        start = ms_to_samples(evs[indices[0]].onset, target_sr)
+        last = evs[indices[-1]]
+        end = ms_to_samples(last.onset + sum(last.duration), target_sr)
+        hash = content_key(
+            {
+                "events": [
+                    keys[i]
+                    or ms_to_samples(evs[i].onset + sum(evs[i].duration), target_sr)
+                    - ms_to_samples(evs[i].onset, target_sr)
+                    for i in indices
+                ],
+                "offsets": [
+                    ms_to_samples(evs[i].onset, target_sr) - start for i in indices
+                ],
+            }
+        )
+        segments.append(
+            ({"measure": measure, "hash": hash, "start": start, "end": end}, indices)
+        )
+    return segments
+
+
+class NoteRenderer:
+    """Renders notes as they're needed. With jobs > 1, notes are rendered in a
+    process pool, keeping up to lookahead notes in flight ahead of the one being
+    waited for, so that the start of the score is ready before the end has been
+    rendered. Notes must be scheduled in the order they'll be needed."""
+
+    def __init__(self, jobs: int, cache: NoteCache | None, lookahead: int = 0):
+        self.cache = cache
+        self.executor = ProcessPoolExecutor(jobs) if jobs > 1 else None
+        self.lookahead = lookahead or 4 * jobs
+        self.queue: Deque[Tuple[str, NoteJob]] = deque()
+        self.scheduled: Set[str] = set()
+        self.futures: Dict[str, Future] = {}
+        self.rendered: Dict[str, np.ndarray] = {}
+        """notes rendered in the pool that are still going to be needed again"""
+        self.uses: Dict[str, int] = {}
+        """how many more times each note in rendered will be needed"""
+
+    def schedule(self, key: str, job: NoteJob) -> None:
+        if self.executor is None:
+            return
+        self.uses[key] = self.uses.get(key, 0) + 1
+        if key in self.scheduled:
+            return
+        self.scheduled.add(key)
+        if self.cache is None or self.cache.get(key) is None:
+            self.queue.append((key, job))
+
+    def top_up(self) -> None:
+        while self.queue and len(self.futures) < self.lookahead:
+            key, job = self.queue.popleft()
+            self.futures[key] = cast(ProcessPoolExecutor, self.executor).submit(
+                traced_render_note, job, tracer.enabled
+            )
+
+    def get(self, key: str, job: NoteJob) -> np.ndarray:
+        if key in self.rendered:
+            y = self.rendered[key]
+        else:
+            self.top_up()
+            if key not in self.futures:
+                return cached_render_note(job, key, self.cache)
+            y, events = self.futures.pop(key).result()
+            tracer.extend(events)
+            self.top_up()
+            self.rendered[key] = y
+            if self.cache is not None:
+                self.cache.put(key, y)
+        # let go of notes that won't be needed again, so that memory use doesn't
+        # grow with the length of the score
+        self.uses[key] = self.uses.get(key, 1) - 1
+        if self.uses[key] <= 0:
+            del self.rendered[key]
+        return y
+
+    def close(self) -> None:
+        if self.executor is not None:
+            self.executor.shutdown(cancel_futures=True)
+
+
+class Timeline:
+    """The measure segments of every part of a score, in the order they come in
+    the timeline, and the notes that need rendering for them. Planning a score is
+    kept apart from rendering it, so that the notes of several scores can be
+    scheduled on one NoteRenderer before any of them are rendered.
+
+    Only start_ms to end_ms (by default, the whole score) is rendered, and the
+    buffers start at start_ms. Notes keep their place on the score's timeline, so
+    they sound exactly as they would in a full render, and any that hang over
+    either end are cut off. Measures found in stems are spliced in without
+    rendering any of their notes."""
+
+    def __init__(
+        self,
+        events: Dict[str, List[Note]],
+        words_map: Dict[str, WordInfo],
+        settings: RenderSettings,
+        stems: StemStore | None = None,
+        start_ms: float = 0,
+        end_ms: float | None = None,
+    ):
+        self.target_sr = settings["target_sr"]
+        self.stems = stems
+        self.whole = start_ms == 0 and end_ms is None
+        self.offset = ms_to_samples(start_ms, self.target_sr)
+        self.total_samples = (
+            ms_to_samples(
+                total_duration(events) if end_ms is None else end_ms, self.target_sr
+            )
+            - self.offset
+        )
+        self.part_ids = list(events)
+        self.evs_list = list(events.values())
+
+        self.note_jobs = [
+            [
+                (
+                    note_job(event, words_map, settings)
+                    if isinstance(event, Pitch)
+                    else None
+                )
+                for event in evs
+            ]
+            for evs in self.evs_list
+        ]
+        self.note_keys = [
+            [note_key(job) if job else None for job in part_jobs]
+            for part_jobs in self.note_jobs
+        ]
+        self.segments = [
+            measure_segments(evs, keys, self.target_sr)
+            for evs, keys in zip(self.evs_list, self.note_keys)
+        ]
+
+        # only which segments can be reused is worked out up front; each is loaded
+        # when render gets to it, so the previous render isn't all held in memory
+        self.reused: Set[str] = set()
+        if stems is not None:
+            for part_segments in self.segments:
+                for segment, indices in part_segments:
+                    if stems.has(segment["hash"]):
+                        self.reused.add(segment["hash"])
+
+        self.units = sorted(
+            (
+                (segment["start"], i, segment, indices)
+                for i, part_segments in enumerate(self.segments)
+                for segment, indices in part_segments
+            ),
+            key=lambda unit: unit[:2],
+        )
+
+    def notes(self) -> int:
+        """the number of notes that will be rendered or looked up"""
+        return sum(
+            1
+            for _, i, segment, indices in self.units
+            if segment["hash"] not in self.reused
+            for j in indices
+            if self.note_jobs[i][j] is not None
+        )
+
+    def schedule(self, renderer: "NoteRenderer") -> None:
+        for _, i, segment, indices in self.units:
+            if segment["hash"] not in self.reused:
+                for j in indices:
+                    if (job := self.note_jobs[i][j]) is not None:
+                        renderer.schedule(cast(str, self.note_keys[i][j]), job)
+
+    def render(
+        self,
+        renderer: "NoteRenderer",
+        allocate: Callable[[int], np.ndarray] | None = None,
+    ) -> Generator[Tuple[List[np.ndarray], int], None, None]:
+        """Renders the segments in order, with notes from renderer, which they must
+        already have been scheduled on. Yields like render_timeline."""
+        offset, total_samples = self.offset, self.total_samples
+        evs_list, segments = self.evs_list, self.segments
+
+        def place(part: np.ndarray, start: int, y: np.ndarray) -> None:
+            """writes y into part at sample start of the score, cutting off anything
+            outside the buffer"""
+            start -= offset
+            begin = max(0, -start)
+            end = min(len(y), total_samples - start)
+            if begin < end:
+                part[start + begin : start + end] = y[begin:end]
+
+        parts = [
+            (
+                np.zeros(total_samples, dtype=np.float32)
+                if allocate is None
+                else allocate(total_samples)
+            )
+            for _ in evs_list
+        ]
+        done = [
+            (
+                min(max(part_segments[0][0]["start"] - offset, 0), total_samples)
+                if part_segments
+                else total_samples
+            )
+            for part_segments in segments
+        ]
+        remaining = [len(part_segments) for part_segments in segments]
+
+        for _, i, segment, indices in self.units:
+            print(f"{i}: measure {segment['measure']}")
+            stem = (
+                self.stems.get(segment["hash"])
+                if self.stems is not None and segment["hash"] in self.reused
+                else None
+            )
+            if stem is not None:
+                print("unchanged")
+                with tracer.span(
+                    "append",
+                    part=self.part_ids[i],
+                    measure=segment["measure"],
+                    samples=len(stem),
+                ):
+                    place(parts[i], segment["start"], stem)
+                del stem
+            else:
+                # including a saved segment that can't be read after all, whose
+                # notes weren't scheduled, so are rendered as they're needed
+                for j in indices:
+                    event = evs_list[i][j]
+                    job, key = self.note_jobs[i][j], self.note_keys[i][j]
+                    print(sum(event.duration))
+                    if job is not None and key is not None:
+                        print(cast(Pitch, event).lyric_word)
+                        with tracer.span(
+                            "note",
+                            part=self.part_ids[i],
+                            measure=segment["measure"],
+                            word=job["word"],
+                        ) as span:
+                            tuned_y = renderer.get(key, job)
+                            span["samples"] = len(tuned_y)
+                        with tracer.span(
+                            "append", part=self.part_ids[i], samples=len(tuned_y)
+                        ):
+                            place(
+                                parts[i],
+                                ms_to_samples(event.onset, self.target_sr),
+                                tuned_y,
+                            )
+                    else:
+                        print("rest")
+                start, end = segment["start"] - offset, segment["end"] - offset
+                # segments cut off by the ends of the range can't be reused
+                if self.stems is not None and 0 <= start and end <= total_samples:
+                    self.stems.put(segment["hash"], parts[i][start:end])
+            remaining[i] -= 1
+            done[i] = (
+                min(segment["end"] - offset, total_samples)
+                if remaining[i]
+                else total_samples
+            )
+            yield parts, min(done)
+
+        if self.stems is not None and self.whole:
+            # the manifest only lists whole parts, so it's left alone by partial
+            # renders
+            self.stems.save_manifest(
+                {
+                    part_id: [segment for segment, _ in segments[i]]
+                    for i, part_id in enumerate(self.part_ids)
+                }
+            )
+
+
+def render_timeline(
+    events: Dict[str, List[Note]],
+    words_map: Dict[str, WordInfo],
+    settings: RenderSettings,
+    jobs: int = 1,
+    cache: NoteCache | None = None,
+    stems: StemStore | None = None,
+    start_ms: float = 0,
+    end_ms: float | None = None,
+    allocate: Callable[[int], np.ndarray] | None = None,
+) -> Iterator[Tuple[List[np.ndarray], int]]:
+    """Renders every part a measure at a time, going through the measures of all
+    the parts in timeline order. Each time a measure is done, this yields the part
+    buffers along with the sample that every part has been rendered up to, so
+    that everything before it can be mixed and output straight away.
+
+    Every buffer is as long as the longest part and each note is written at its
+    onset, so rests are just left silent. With jobs > 1, notes are rendered ahead
+    in a process pool; the results are identical to rendering them serially.
+    Notes found in cache aren't rendered again, and identical notes are only
+    rendered once. See Timeline for start_ms, end_ms and stems.
+
+    allocate makes a zeroed float32 buffer of a given length for each part (by
+    default, in memory)."""
+    timeline = Timeline(events, words_map, settings, stems, start_ms, end_ms)
+    renderer = NoteRenderer(jobs, cache)
+    timeline.schedule(renderer)
+    try:
+        yield from timeline.render(renderer, allocate)
+    finally:
+        renderer.close()
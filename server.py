@@ -0,0 +1,228 @@
+"""Keeps a rendering process running, so that rendering lots of small scores doesn't
+pay for importing librosa, compiling pyin and loading words every time. Scores are
+sent over HTTP (on a local port or a unix socket), and the audio is streamed back
+as it's rendered:
+
+python3 server.py [--port PORT | --socket PATH]
+curl --data-binary @baa.musicxml -o baa.wav \\
+    "http://localhost:8765/render?part=Tenor&part=Tenor%202&part=Bass"
+
+Any of main.py's options can be given as query parameters, e.g. engine=rubberband
+or gain=-3 (repeat a parameter for options that take several values, and leave
+the value empty for flags such as low_memory=)."""
+
+from argparse import ArgumentParser
+from contextlib import redirect_stdout
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import UnixStreamServer
+from traceback import print_exc
+from typing import BinaryIO, Dict, List, NoReturn, cast
+from urllib.parse import parse_qsl, urlsplit
+import io
+import os
+import sys
+
+from main import make_arg_parser, output_format, sing
+from note_cache import NoteCache
+from output import CONTENT_TYPES
+import audio
+import numpy as np
+
+PASSED_THROUGH = {"part", "name"}
+"""query parameters that aren't options"""
+
+NOT_ALLOWED = {"output", "stream", "trace", "incremental", "check", "help"}
+"""options that would write files on the server, are always on, or don't render
+any audio to send back"""
+
+
+class LastLine(io.TextIOBase):
+    """Passes output on to file, remembering the last line, which is what util.error
+    prints when a render fails"""
+
+    def __init__(self, file):
+        self.file = file
+        self.last_line = ""
+
+    def write(self, text: str) -> int:
+        if lines := [line for line in text.splitlines() if line.strip()]:
+            self.last_line = lines[-1]
+        return self.file.write(text)
+
+    def flush(self) -> None:
+        self.file.flush()
+
+
+class ResponseBody(io.RawIOBase):
+    """The body of a successful response. The status and headers are only sent
+    once the first byte of audio is ready, so that a render which fails before
+    then can still get an error response."""
+
+    def __init__(self, handler: BaseHTTPRequestHandler):
+        self.handler = handler
+        self.content_type = "audio/wav"
+        self.started = False
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        if not self.started:
+            self.handler.send_response(200)
+            self.handler.send_header("Content-Type", self.content_type)
+            self.handler.end_headers()
+            self.started = True
+        self.handler.wfile.write(data)
+        return len(data)
+
+    def flush(self) -> None:
+        self.handler.wfile.flush()
+
+
+def render_args(query: str) -> List[str]:
+    """main.py's command line for the parameters of a request"""
+    params = parse_qsl(query, keep_blank_values=True)
+    names = [value for key, value in params if key == "part"]
+    if not names:
+        raise ValueError("give at least one part")
+    args = [next((value for key, value in params if key == "name"), "score"), *names]
+    options: Dict[str, List[str]] = {}
+    for key, value in params:
+        # argparse takes any unambiguous prefix of an option, so out= is --output
+        option = key.replace("-", "_")
+        if any(name.startswith(option) for name in NOT_ALLOWED):
+            raise ValueError(f"{key} can't be used here")
+        if key not in PASSED_THROUGH:
+            options.setdefault(key, []).extend([value] if value else [])
+    for key, values in options.items():
+        args += [f"--{key.replace('_', '-')}", *values]
+    return args
+
+
+def reject_args(message: str) -> NoReturn:
+    raise ValueError(message)
+
+
+class RenderHandler(BaseHTTPRequestHandler):
+    server: "RenderServer"
+
+    def do_POST(self) -> None:
+        url = urlsplit(self.path)
+        if url.path != "/render":
+            self.send_error(404)
+            return
+        length = int(self.headers.get("Content-Length", 0))
+        source = io.BytesIO(self.rfile.read(length))
+
+        log = LastLine(sys.stdout)
+        body = ResponseBody(self)
+        try:
+            with redirect_stdout(log):
+                args = self.server.arg_parser.parse_args(render_args(url.query))
+                if output_format(args)["format"] == "flac":
+                    # flac's header goes in last, so it can't be streamed
+                    raise ValueError("flac can't be sent back; use wav or opus")
+                body.content_type = CONTENT_TYPES[output_format(args)["format"]]
+                sing(args, source, cast(BinaryIO, body), self.server.note_cache)
+        except (ValueError, SystemExit) as e:
+            if isinstance(e, SystemExit) and e.code == 0:
+                message = ""
+            else:
+                message = str(e) if isinstance(e, ValueError) else log.last_line
+            if body.started:
+                # too late to report it; the client gets a short file
+                self.log_error("render failed after starting: %s", message)
+            else:
+                self.send_error(400, explain=message or "render failed")
+            return
+        except Exception as e:
+            # e.g. a broken file in a cache; log_error escapes newlines, so the
+            # traceback follows it on stderr
+            message = f"{type(e).__name__}: {e}"
+            self.log_error("render failed: %s", message)
+            print_exc()
+            if not body.started:
+                self.send_error(500, explain=message)
+            return
+        if not body.started:
+            # every render sends a header at least, but don't leave the client
+            # without a response if one somehow doesn't
+            self.send_error(500, explain="the render didn't produce any audio")
+
+    def address_string(self) -> str:
+        # unix sockets don't have an address
+        return str(self.client_address[0]) if self.client_address else "local"
+
+
+class RenderServer(HTTPServer):
+    def __init__(self, address, note_cache: NoteCache):
+        super().__init__(address, RenderHandler)
+        self.note_cache = note_cache
+        self.arg_parser = make_arg_parser()
+        # report bad options to the client, rather than exiting the server
+        self.arg_parser.error = reject_args  # type: ignore[method-assign]
+
+
+class UnixRenderServer(UnixStreamServer, RenderServer):
+    def __init__(self, path: str, note_cache: NoteCache):
+        RenderServer.__init__(self, path, note_cache)
+
+    def server_bind(self) -> None:
+        UnixStreamServer.server_bind(self)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+
+def warm_up() -> None:
+    """Compiles pyin before the first score comes in"""
+    audio.track_pitch(np.zeros(4096, dtype=np.float32), 44100)
+
+
+def main() -> None:
+    arg_parser = ArgumentParser(description="serve renders from a warm process")
+    address = arg_parser.add_mutually_exclusive_group()
+    address.add_argument(
+        "--port",
+        type=int,
+        default=8765,
+        help="port to listen on, on localhost (default: 8765)",
+    )
+    address.add_argument("--socket", metavar="PATH", help="unix socket to listen on")
+    arg_parser.add_argument(
+        "--note-cache",
+        default="note-cache",
+        metavar="DIR",
+        help="directory to cache rendered notes in (default: note-cache)",
+    )
+    arg_parser.add_argument(
+        "--note-cache-size",
+        type=int,
+        default=1024,
+        metavar="MB",
+        help="maximum size of the note cache on disk (default: 1024)",
+    )
+    args = arg_parser.parse_args()
+
+    # one cache for every render, so that notes stay in memory between scores
+    note_cache = NoteCache(args.note_cache, max_bytes=args.note_cache_size << 20)
+
+    warm_up()
+
+    if args.socket is not None:
+        if os.path.exists(args.socket):
+            os.remove(args.socket)
+        server: RenderServer = UnixRenderServer(args.socket, note_cache)
+        print(f"listening on {args.socket}")
+    else:
+        server = RenderServer(("localhost", args.port), note_cache)
+        print(f"listening on http://localhost:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,119 @@
+from typing import Dict, List, TypedDict
+import json
+import mmap
+import os
+import numpy as np
+
+
+class MeasureSegment(TypedDict):
+    """The rendered audio of the events starting in one measure of a part"""
+
+    measure: str
+    hash: str
+    start: int
+    """first sample of the segment in the part"""
+
+    end: int
+
+
+class StemStore:
+    """Rendered measure segments of a score from a previous run, stored in
+    directory as one .npy per segment (named by its content hash) along with a
+    manifest of which segments make up each part. Measures whose hash hasn't
+    changed can be spliced back into the parts rather than being re-rendered."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.manifest_path = os.path.join(directory, "manifest.json")
+        self.manifest: Dict[str, List[MeasureSegment]] = {}
+        os.makedirs(directory, exist_ok=True)
+        if os.path.isfile(self.manifest_path):
+            with open(self.manifest_path) as f:
+                self.manifest = json.load(f)["parts"]
+
+    def path(self, hash: str) -> str:
+        return os.path.join(self.directory, f"{hash}.npy")
+
+    def has(self, hash: str) -> bool:
+        return os.path.isfile(self.path(hash))
+
+    def get(self, hash: str) -> np.ndarray | None:
+        try:
+            return np.load(self.path(hash))
+        except OSError:
+            return None
+        except ValueError:
+            # a broken file, which put would otherwise never replace
+            os.remove(self.path(hash))
+            return None
+
+    def put(self, hash: str, y: np.ndarray) -> None:
+        path = self.path(hash)
+        if os.path.isfile(path):
+            return
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.save(f, y)
+        os.replace(tmp_path, path)
+
+    def save_manifest(self, parts: Dict[str, List[MeasureSegment]]) -> None:
+        """Records the segments of every part in this run, and deletes any segment
+        files that are no longer part of the manifest (segments of parts that
+        weren't rendered this time are kept)."""
+        self.manifest = {**self.manifest, **parts}
+        tmp_path = f"{self.manifest_path}.{os.getpid()}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"parts": self.manifest}, f)
+        os.replace(tmp_path, self.manifest_path)
+
+        in_use = {
+            f"{segment['hash']}.npy"
+            for segments in self.manifest.values()
+            for segment in segments
+        }
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".npy") and entry.name not in in_use:
+                os.remove(entry.path)
+
+
+class MappedParts:
+    """Part buffers backed by float32 files in directory rather than by memory, for
+    scores too long to hold every part in RAM. Once the start of the parts has
+    been mixed, release lets go of it, so that only the samples between what's
+    been mixed and what's being rendered need to stay resident."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.maps: List[mmap.mmap] = []
+
+    def allocate(self, n_samples: int) -> np.ndarray:
+        if n_samples == 0:
+            # empty files can't be mapped
+            return np.zeros(0, dtype=np.float32)
+        path = os.path.join(self.directory, f"part-{len(self.maps)}.f32")
+        with open(path, "w+b") as f:
+            # a sparse file, so it starts out silent without writing anything
+            f.truncate(n_samples * 4)
+            buffer = mmap.mmap(f.fileno(), n_samples * 4)
+        self.maps.append(buffer)
+        return np.frombuffer(buffer, dtype=np.float32)
+
+    def release(self, end: int) -> None:
+        """drops samples before end from memory (they're still in the files, but
+        they won't be read again)"""
+        length = end * 4 // mmap.PAGESIZE * mmap.PAGESIZE
+        if length == 0 or not hasattr(mmap, "MADV_DONTNEED"):
+            return
+        for buffer in self.maps:
+            buffer.madvise(mmap.MADV_DONTNEED, 0, min(length, len(buffer)))
+
+    def close(self) -> None:
+        """unmaps the files, so that they can be deleted. Arrays from allocate
+        mustn't be used after this."""
+        for buffer in self.maps:
+            try:
+                buffer.close()
+            except BufferError:
+                # an array still points into it, so it's unmapped once that goes
+                pass
+        self.maps = []
@@ -0,0 +1,111 @@
+from contextlib import contextmanager
+from time import perf_counter_ns
+from typing import Dict, Iterator, List, Tuple, TypedDict
+import json
+import os
+import threading
+
+
+class TraceEvent(TypedDict):
+    """A complete ("X") event in Chrome's trace event format, which can be opened in
+    chrome://tracing or https://ui.perfetto.dev"""
+
+    name: str
+    ph: str
+    ts: float
+    """start, in microseconds"""
+
+    dur: float
+    """duration, in microseconds"""
+
+    pid: int
+    tid: int
+    args: Dict[str, object]
+
+
+class Tracer:
+    """Records how long each stage of a render takes. Does nothing until enabled, so
+    spans can be left in the code at little cost. Timestamps come from a monotonic
+    clock shared by every process, so spans recorded in worker processes line up
+    with the ones recorded here."""
+
+    def __init__(self) -> None:
+        self.enabled = False
+        self.events: List[TraceEvent] = []
+
+    @contextmanager
+    def span(self, name: str, **args: object) -> Iterator[Dict[str, object]]:
+        """Times the body of a with block. The span's args are yielded, so that
+        attributes only known at the end (such as a sample count) can be added."""
+        if not self.enabled:
+            yield args
+            return
+        start = perf_counter_ns()
+        try:
+            yield args
+        finally:
+            self.events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": start / 1000,
+                    "dur": (perf_counter_ns() - start) / 1000,
+                    "pid": os.getpid(),
+                    "tid": threading.get_ident(),
+                    "args": args,
+                }
+            )
+
+    def take(self) -> List[TraceEvent]:
+        """removes and returns every event recorded so far, e.g. to send them back
+        from a worker process"""
+        events, self.events = self.events, []
+        return events
+
+    def extend(self, events: List[TraceEvent]) -> None:
+        self.events.extend(events)
+
+    def write(self, file_name: str) -> None:
+        with open(file_name, "w") as f:
+            json.dump({"traceEvents": self.events, "displayTimeUnit": "ms"}, f)
+
+    def stats(self, top: int = 15) -> str:
+        """A table of the spans that took the most time, excluding the time spent in
+        the spans nested inside them"""
+        totals: Dict[str, Tuple[int, float, float]] = {}
+        """name -> (count, total, self time), in microseconds"""
+
+        by_thread: Dict[Tuple[int, int], List[TraceEvent]] = {}
+        for event in self.events:
+            by_thread.setdefault((event["pid"], event["tid"]), []).append(event)
+        for events in by_thread.values():
+            # parents start no later than their children, and end no earlier
+            events.sort(key=lambda event: (event["ts"], -event["dur"]))
+            stack: List[Tuple[TraceEvent, List[float]]] = []
+            self_times: List[Tuple[str, float, List[float]]] = []
+            for event in events:
+                while stack and (
+                    stack[-1][0]["ts"] + stack[-1][0]["dur"] <= event["ts"]
+                ):
+                    stack.pop()
+                children: List[float] = []
+                if stack:
+                    stack[-1][1].append(event["dur"])
+                stack.append((event, children))
+                self_times.append((event["name"], event["dur"], children))
+            for name, dur, children in self_times:
+                count, total, self_time = totals.get(name, (0, 0.0, 0.0))
+                totals[name] = (count + 1, total + dur, self_time + dur - sum(children))
+
+        lines = [f"{'span':<20}{'count':>8}{'total ms':>12}{'self ms':>12}"]
+        for name, (count, total, self_time) in sorted(
+            totals.items(), key=lambda item: -item[1][2]
+        )[:top]:
+            lines.append(
+                f"{name:<20}{count:>8}{total / 1000:>12.1f}{self_time / 1000:>12.1f}"
+            )
+        return "\n".join(lines)
+
+
+tracer = Tracer()
+"""the tracer for this process"""
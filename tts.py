@@ -1,27 +1,49 @@
-from typing import Dict, List, TypedDict
+from typing import TYPE_CHECKING, Dict, List, Tuple, TypedDict
 import os
-from dotenv import load_dotenv
 import base64
 import csv
-import requests
-from util import error, strip_word
+import hashlib
+import io
+from concurrent.futures import ThreadPoolExecutor
+from functools import cache
+from threading import Lock
+from util import error, s_to_ms, strip_word
 import json
-from time import sleep
+from time import monotonic, sleep
 
-load_dotenv()
+if TYPE_CHECKING:
+    import requests
+
+# requests, dotenv and pydub are only imported once a word actually needs
+# fetching, so that checking a score whose words are all cached stays quick
 
-XI_API_KEY = os.getenv("XI_API_KEY")
 VOICE_ID = "onwK4e9ZLuTAKqWW03F9"  # Daniel; see https://api.elevenlabs.io/v1/voices
 
-url = f"https://api.elevenlabs.io/v1/text-to-speech/{VOICE_ID}/stream/with-timestamps"
+MAX_RETRIES = 5
+"""how many times to retry a request that was rate limited, hit a server error or
+couldn't get through"""
+
+TIMEOUT = (10, 60)
+"""seconds to wait for a connection, and for each read of the response, before
+giving up on a request and retrying it"""
 
-headers = {
-    "Content-Type": "application/json",
-    "xi-api-key": XI_API_KEY,
-}
+@cache
+def api_settings() -> Tuple[str, Dict[str, str]]:
+    """The url to fetch words from and the headers to send, from the environment
+    (or .env)"""
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    # can be pointed at a local server for testing
+    api_url = os.getenv("XI_API_URL", "https://api.elevenlabs.io")
+    headers = {
+        "Content-Type": "application/json",
+        "xi-api-key": os.getenv("XI_API_KEY", ""),
+    }
+    return f"{api_url}/v1/text-to-speech/{VOICE_ID}/stream/with-timestamps", headers
 
-if not os.path.isdir(f'audio-cache-{VOICE_ID}'):
-    os.mkdir(f'audio-cache-{VOICE_ID}')
+def cache_dir() -> str:
+    return f"audio-cache-{VOICE_ID}"
 
 class WordInfo(TypedDict):
     character_start_times: List[float]
@@ -30,44 +52,158 @@ class WordInfo(TypedDict):
     audio_bytes: bytes
 
 def cache_path(word: str) -> str:
-    return f"audio-cache-{VOICE_ID}/{word}"
+    return f"{cache_dir()}/{word}"
+
+loaded_words: Dict[str, WordInfo] = {}
+"""words already read from the cache by this process, which a long-running
+process (see server.py) can keep reusing"""
 
 def get_cache(word: str) -> WordInfo | None:
+    if word in loaded_words:
+        return loaded_words[word]
     file = cache_path(word)
     if os.path.isfile(f"{file}.mp3"):
+        # the audio itself is read from the word pack (see word_pack.py) when it's
+        # needed, so it isn't loaded here
         info: WordInfo = { 'audio_bytes': b'', 'character_end_times': [], 'character_start_times': [], 'characters': [] }
-        with open(f"{file}.mp3", "rb") as f:
-            info["audio_bytes"] = base64.b64encode(f.read())
-            f.seek(0)
         with open(f"{file}.csv", "r") as f:
             reader = csv.reader(f)
             info["character_start_times"] = list(map(float, reader.__next__()))
             info["character_end_times"] = list(map(float, reader.__next__()))
             info["characters"] = reader.__next__()
+        loaded_words[word] = info
         return info
     else:
         return None
 
 
-def streaming_tts(word: str, previous: str | None, next: str | None) -> WordInfo:
-    response = requests.post(
-        url,
-        json={
-            "text": word,
-            "model_id": "eleven_multilingual_v2",
-            "voice_settings": {"stability": 0.5, "similarity_boost": 0.75},
-            "previous_text": previous,
-            "next_words": next,
-        },
-        headers=headers,
-        stream=True,
-    )
-    if response.status_code != 200:
-        error(
-            f"Error encountered, status: {response.status_code}, "
-            f"content: {response.text}"
-        )
+digests: Dict[str, str] = {}
+"""digest of each word's mp3, by word"""
+
+def digest(audio_bytes: bytes) -> str:
+    return hashlib.sha256(audio_bytes).hexdigest()[:16]
+
+def audio_digest(word: str) -> str:
+    """A digest of the word's cached mp3, so that anything made from its audio
+    (its place in a word pack, its analysis, rendered notes) can tell when the
+    word has been fetched again"""
+    if word not in digests:
+        with open(f"{cache_path(word)}.mp3", "rb") as f:
+            digests[word] = digest(f.read())
+    return digests[word]
+
+
+def save_cache(word: str, word_info: WordInfo) -> None:
+    """Saves a word to the cache. Each file is written under a temporary name and
+    then moved into place, and the mp3 (which get_cache looks for) goes last, so
+    a half-written word is never picked up."""
+    os.makedirs(cache_dir(), exist_ok=True)
+    file = cache_path(word)
+    tmp_suffix = f".{os.getpid()}.tmp"
+    with open(f"{file}.csv{tmp_suffix}", "w") as f:
+        writer = csv.writer(f)
+        writer.writerow(word_info["character_start_times"])
+        writer.writerow(word_info["character_end_times"])
+        writer.writerow(word_info["characters"])
+    os.replace(f"{file}.csv{tmp_suffix}", f"{file}.csv")
+    with open(f"{file}.mp3{tmp_suffix}", "wb") as f:
+        f.write(word_info["audio_bytes"])
+    os.replace(f"{file}.mp3{tmp_suffix}", f"{file}.mp3")
+    digests[word] = digest(word_info["audio_bytes"])
+
+
+class RateLimiter:
+    """A token bucket: allows rate requests per second on average, with bursts of
+    up to burst requests. Safe to share between threads."""
+
+    def __init__(self, rate: float, burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.last = monotonic()
+        self.lock = Lock()
+
+    def acquire(self) -> None:
+        while True:
+            with self.lock:
+                now = monotonic()
+                self.tokens = min(
+                    self.burst, self.tokens + (now - self.last) * self.rate
+                )
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            sleep(wait)
+
+
+def make_session(workers: int) -> "requests.Session":
+    """A session whose connection pool is big enough for every worker"""
+    import requests
+    from requests.adapters import HTTPAdapter
+
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=1, pool_maxsize=workers)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def streaming_tts(
+    word: str,
+    previous: str | None,
+    next: str | None,
+    session: "requests.Session | None" = None,
+    limiter: RateLimiter | None = None,
+) -> WordInfo:
+    import requests
+
+    url, headers = api_settings()
+    for attempt in range(MAX_RETRIES + 1):
+        if limiter is not None:
+            limiter.acquire()
+        retry_after = None
+        try:
+            response = (session or requests).post(
+                url,
+                json={
+                    "text": word,
+                    "model_id": "eleven_multilingual_v2",
+                    "voice_settings": {"stability": 0.5, "similarity_boost": 0.75},
+                    "previous_text": previous,
+                    "next_words": next,
+                },
+                headers=headers,
+                stream=True,
+                timeout=TIMEOUT,
+            )
+            if response.status_code == 200:
+                return read_stream(response)
+            failure = (
+                f"Error encountered, status: {response.status_code}, "
+                f"content: {response.text}"
+            )
+        except requests.RequestException as e:
+            # a connection that failed, stalled or dropped part way through
+            failure = f"Error encountered: {e}"
+        else:
+            if response.status_code != 429 and response.status_code < 500:
+                break
+            retry_after = response.headers.get("Retry-After")
+            response.close()
+        if attempt < MAX_RETRIES:
+            # exponential backoff, unless the server says how long to wait
+            sleep(
+                float(retry_after)
+                if retry_after is not None and retry_after.isdigit()
+                else 0.5 * 2**attempt
+            )
+    error(failure)
+
 
+def read_stream(response: "requests.Response") -> WordInfo:
+    """the audio and alignment of a streamed response"""
     audio_bytes: bytes = b""
     character_start_times = []
     character_end_times = []
@@ -106,36 +242,156 @@ def streaming_tts(word: str, previous: str | None, next: str | None) -> WordInfo
     }
 
 
-def tts(full_texts: Dict[str, List[str]]) -> Dict[str, WordInfo]:
+def split_phrase(
+    words: List[str], phrase_info: WordInfo
+) -> Dict[str, WordInfo] | None:
+    """Splits the audio of a phrase (words joined by spaces) into one entry per word,
+    using the character alignment. Each word is cut halfway through the gaps
+    either side of it. Returns None if the alignment doesn't match the text."""
+    if "".join(phrase_info["characters"]) != " ".join(words):
+        return None
+    from pydub import AudioSegment
+
+    phrase_audio = AudioSegment.from_file(
+        io.BytesIO(phrase_info["audio_bytes"]), format="mp3"
+    )
+    starts = phrase_info["character_start_times"]
+    ends = phrase_info["character_end_times"]
+
+    spans: List[Tuple[int, int]] = []
+    pos = 0
+    for word in words:
+        spans.append((pos, pos + len(word) - 1))
+        pos += len(word) + 1
+
+    word_infos: Dict[str, WordInfo] = {}
+    for k, (first, last) in enumerate(spans):
+        if words[k] in word_infos:
+            continue
+        cut_start = s_to_ms(
+            0 if k == 0 else (ends[spans[k - 1][1]] + starts[first]) / 2
+        )
+        cut_end = (
+            len(phrase_audio)
+            if k == len(spans) - 1
+            else s_to_ms((ends[last] + starts[spans[k + 1][0]]) / 2)
+        )
+        word_audio = io.BytesIO()
+        phrase_audio[cut_start:cut_end].export(word_audio, format="mp3")
+        offset = cut_start / 1000
+        word_infos[words[k]] = {
+            "audio_bytes": word_audio.getvalue(),
+            "character_start_times": [t - offset for t in starts[first : last + 1]],
+            "character_end_times": [t - offset for t in ends[first : last + 1]],
+            "characters": phrase_info["characters"][first : last + 1],
+        }
+    return word_infos
+
+
+Phrase = Tuple[List[str], str | None, str | None]
+"""some consecutive (stripped) words to fetch together, with the text before and
+after them"""
+
+
+def plan_phrases(
+    full_texts: Dict[str, List[str]],
+    batch: int = 1,
+    needed: set[str] | None = None,
+) -> Tuple[Dict[str, WordInfo], List[Phrase]]:
+    """The words in full_texts that are already cached, and the phrases that the
+    rest would be fetched in (see tts). Nothing is fetched."""
     words_map: Dict[str, WordInfo] = {}
+    scheduled: set[str] = set()
+    phrases: List[Phrase] = []
+
+    def needs_fetch(word: str) -> bool:
+        if word in words_map or word in scheduled:
+            return False
+        if needed is not None and word not in needed:
+            return False
+        cache = get_cache(word)
+        if cache is not None:
+            words_map[word] = cache
+            return False
+        return True
 
     for words in full_texts.values():
-        for i, word in enumerate(words):
-            stripped_word = strip_word(word)
-            if stripped_word in words_map:
-                continue
-            cache = get_cache(stripped_word)
-            if cache is not None:
-                words_map[stripped_word] = cache
+        stripped_words = [strip_word(word) for word in words]
+        i = 0
+        while i < len(words):
+            if not needs_fetch(stripped_words[i]):
+                i += 1
                 continue
-
-            word_info = streaming_tts(
-                stripped_word,
-                None if i == 0 else " ".join(words[:i]),
-                " ".join(words[i + 1 :]) if i + 1 < len(words) else None,
+            j = i + 1
+            while (
+                j < len(words) and j - i < batch and needs_fetch(stripped_words[j])
+            ):
+                j += 1
+            phrases.append(
+                (
+                    stripped_words[i:j],
+                    None if i == 0 else " ".join(words[:i]),
+                    " ".join(words[j:]) if j < len(words) else None,
+                )
             )
+            scheduled.update(stripped_words[i:j])
+            i = j
 
-            words_map[stripped_word] = word_info
+    return words_map, phrases
 
-            with open(f"audio-cache-{VOICE_ID}/{stripped_word}.mp3", "wb") as f:
-                f.write(word_info["audio_bytes"])
-            with open(f"audio-cache-{VOICE_ID}/{stripped_word}.csv", "w") as f:
-                writer = csv.writer(f)
-                writer.writerow(word_info["character_start_times"])
-                writer.writerow(word_info["character_end_times"])
-                writer.writerow(word_info["characters"])
 
-            sleep(0.2)  # try to avoid rate limits and be nice to elevenlabs' servers
+def tts(
+    full_texts: Dict[str, List[str]],
+    workers: int = 4,
+    rate: float = 5.0,
+    batch: int = 1,
+    needed: set[str] | None = None,
+) -> Dict[str, WordInfo]:
+    """Gets every word in full_texts, from the cache where possible. Uncached words
+    are fetched by up to workers threads sharing one session, limited to rate
+    requests per second.
 
-    return words_map
+    With batch > 1, runs of up to batch consecutive uncached words are fetched in
+    one request and split up by their character alignment. Otherwise each word is
+    fetched with the context of its first occurrence, exactly as if they were
+    fetched one at a time.
+
+    If needed is given, only those words are got; the rest of full_texts is still
+    used as context."""
+    words_map, phrases = plan_phrases(full_texts, batch, needed)
 
+    if not phrases:
+        return words_map
+
+    limiter = RateLimiter(rate)
+
+    def fetch(phrase: Phrase) -> Dict[str, WordInfo]:
+        words, previous, next = phrase
+        phrase_info = streaming_tts(" ".join(words), previous, next, session, limiter)
+        word_infos = (
+            {words[0]: phrase_info}
+            if len(words) == 1
+            else split_phrase(words, phrase_info)
+        )
+        if word_infos is None:
+            # the alignment didn't line up with the text, so fall back to fetching
+            # the words one by one
+            word_infos = {}
+            for k, word in enumerate(words):
+                if word not in word_infos:
+                    word_infos[word] = streaming_tts(
+                        word,
+                        " ".join(filter(None, [previous, *words[:k]])) or None,
+                        " ".join(filter(None, [*words[k + 1 :], next])) or None,
+                        session,
+                        limiter,
+                    )
+        for word, word_info in word_infos.items():
+            save_cache(word, word_info)
+        return word_infos
+
+    with make_session(workers) as session, ThreadPoolExecutor(workers) as executor:
+        for word_infos in executor.map(fetch, phrases):
+            words_map.update(word_infos)
+
+    return words_map
@@ -0,0 +1,154 @@
+"""A stand-in for elevenlabs' streaming text to speech endpoint, for testing the
+word fetcher without an API key. Each request gets a tone whose pitch and length
+depend on its text, streamed back in a few chunks with evenly spaced character
+timings, the same way elevenlabs sends them, so the same text always gets the same
+audio. --busy-every makes it answer some requests with 429 to exercise retries.
+
+python3 tts_stub.py [--port 8790] [--latency SECONDS] [--busy-every N]
+
+To check that fetching in parallel gives the same cache as fetching one word at
+a time, fetch the same score into two directories and compare them:
+
+mkdir one four && cp baa.musicxml one && cp baa.musicxml four
+(cd one && XI_API_URL=http://localhost:8790 python3 ../main.py baa Tenor Bass \\
+    --tts-workers 1)
+(cd four && XI_API_URL=http://localhost:8790 python3 ../main.py baa Tenor Bass \\
+    --tts-workers 4)
+diff -r one/audio-cache-* four/audio-cache-*"""
+
+from argparse import ArgumentParser
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from itertools import count
+from threading import Lock
+from time import sleep
+from typing import List
+import base64
+import io
+import json
+import zlib
+import numpy as np
+
+SR = 24000
+
+LEAD = 0.05
+"""seconds of silence either side of the tone"""
+
+CHUNKS = 3
+"""how many lines each response is streamed in"""
+
+
+def speak(text: str) -> bytes:
+    """an mp3 of a harmonic tone, at a pitch picked by the text, lasting longer
+    the longer the text is"""
+    from pydub import AudioSegment
+
+    f0 = 100 + zlib.crc32(text.encode("utf-8")) % 100
+    t = np.arange(int(voiced_seconds(text) * SR)) / SR
+    tone = sum(np.sin(2 * np.pi * f0 * h * t) / h for h in range(1, 6)) * 0.3
+    silence = np.zeros(int(LEAD * SR))
+    y = np.concatenate([silence, tone, silence])
+    segment = AudioSegment(
+        data=(y * 32767).astype("<i2").tobytes(),
+        sample_width=2,
+        frame_rate=SR,
+        channels=1,
+    )
+    audio_bytes = io.BytesIO()
+    segment.export(audio_bytes, format="mp3")
+    return audio_bytes.getvalue()
+
+
+def voiced_seconds(text: str) -> float:
+    return 0.08 * len(text) + 0.1
+
+
+def response_lines(text: str) -> List[bytes]:
+    """the lines of the streamed response: the audio and the characters split
+    into CHUNKS pieces, each with its own alignment"""
+    audio_bytes = speak(text)
+    step = voiced_seconds(text) / max(len(text), 1)
+    lines: List[bytes] = []
+    for chunk in range(CHUNKS):
+        audio_start = chunk * len(audio_bytes) // CHUNKS
+        audio_end = (chunk + 1) * len(audio_bytes) // CHUNKS
+        characters = range(
+            chunk * len(text) // CHUNKS, (chunk + 1) * len(text) // CHUNKS
+        )
+        alignment = {
+            "characters": [text[i] for i in characters],
+            "character_start_times_seconds": [LEAD + i * step for i in characters],
+            "character_end_times_seconds": [LEAD + (i + 1) * step for i in characters],
+        }
+        lines.append(
+            json.dumps(
+                {
+                    "audio_base64": base64.b64encode(
+                        audio_bytes[audio_start:audio_end]
+                    ).decode("ascii"),
+                    "alignment": alignment if len(characters) else None,
+                }
+            ).encode("utf-8")
+        )
+    return lines
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    latency = 0.0
+    busy_every = 0
+    requests = count(1)
+    lock = Lock()
+
+    def do_POST(self) -> None:
+        if not self.path.endswith("/stream/with-timestamps"):
+            self.send_error(404)
+            return
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with self.lock:
+            n = next(self.requests)
+        if self.busy_every and n % self.busy_every == 0:
+            self.send_response(429)
+            self.send_header("Retry-After", "1")
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        sleep(self.latency)
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.end_headers()
+        for line in response_lines(body["text"]):
+            self.wfile.write(line + b"\n")
+            self.wfile.flush()
+        self.close_connection = True
+
+
+def main() -> None:
+    arg_parser = ArgumentParser(description="serve fake elevenlabs words locally")
+    arg_parser.add_argument("--port", type=int, default=8790)
+    arg_parser.add_argument(
+        "--latency",
+        type=float,
+        default=0.2,
+        metavar="SECONDS",
+        help="how long each request takes to answer (default: 0.2)",
+    )
+    arg_parser.add_argument(
+        "--busy-every",
+        type=int,
+        default=0,
+        metavar="N",
+        help="answer every Nth request with 429 Too Many Requests",
+    )
+    args = arg_parser.parse_args()
+
+    StubHandler.latency = args.latency
+    StubHandler.busy_every = args.busy_every
+    server = ThreadingHTTPServer(("localhost", args.port), StubHandler)
+    print(f"serving fake words on http://localhost:{args.port}")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()
@@ -16,4 +16,7 @@ def s_to_ms(secs: float) -> int:
   return int(secs * 1000)
 
 def strip_word(word: str) -> str:
- return sub(r"[^a-z]", "", word.lower())
\ No newline at end of file
+ return sub(r"[^a-z]", "", word.lower())
+
+def ms_to_samples(ms: float, sr: int) -> int:
+  return int(round(ms * 0.001 * sr))
@@ -0,0 +1,126 @@
+from typing import TYPE_CHECKING, Dict, Tuple
+from tts import WordInfo, cache_path
+from util import ms_to_samples, s_to_ms
+import os
+import numpy as np
+
+if TYPE_CHECKING:
+    from audio import PitchContour
+
+
+class WordAnalysis:
+    """What the renderer needs to know about a word's audio that only depends on the
+    word, worked out once when it's packed rather than for every note it's sung
+    on. Times are in seconds, so one analysis does for every sample rate."""
+
+    def __init__(
+        self,
+        spans: np.ndarray,
+        f0: np.ndarray,
+        voiced: np.ndarray,
+        hop_s: float,
+        digest: str,
+    ):
+        self.spans = spans
+        """spans[i, j] is where the audio of characters i to j starts and ends once
+        the silence either side has been trimmed"""
+
+        self.f0 = f0
+        """f0 of each frame of the whole word in Hz, as audio.track_pitch reports
+        it; NaN where unvoiced"""
+
+        self.voiced = voiced
+        self.hop_s = hop_s
+        """frame i is centred on i * hop_s"""
+
+        self.digest = digest
+        """tts.audio_digest of the audio that was analysed"""
+
+    def trimmed(self, start_pos: int, end_pos: int) -> Tuple[float, float]:
+        start, end = self.spans[start_pos, end_pos]
+        return float(start), float(end)
+
+    def contour(
+        self, start: float, end: float, n_samples: int, sr: int, hop_length: int = 512
+    ) -> "PitchContour":
+        """The contour of start to end of the word once it's been stretched to
+        n_samples at sr, with frames every hop_length samples as track_pitch would
+        give. Stretching doesn't change the pitch, so each frame just takes the f0
+        of the frame nearest the point of the word it came from."""
+        from audio import PitchContour
+
+        frames = np.arange(1 + n_samples // hop_length)
+        times = start + frames * hop_length * (end - start) / max(n_samples, 1)
+        source = np.clip(np.round(times / self.hop_s).astype(int), 0, len(self.f0) - 1)
+        return PitchContour(self.f0[source], self.voiced[source], hop_length)
+
+
+def analyse_word(y: np.ndarray, sr: int, info: WordInfo, digest: str) -> WordAnalysis:
+    """Analyses the audio of a word, y (whose mp3 has the given digest), given its
+    alignment. Every character span
+    is cropped the way note_job crops a syllable, so the trimmed bounds are the
+    same as stripping the silence from each crop."""
+    import audio
+
+    starts = info["character_start_times"]
+    ends = info["character_end_times"]
+    n = len(starts)
+    spans = np.full((n, n, 2), np.nan)
+    for i in range(n):
+        crop_start = ms_to_samples(s_to_ms(starts[i]), sr)
+        for j in range(i, n):
+            crop = y[crop_start : ms_to_samples(s_to_ms(ends[j]), sr)]
+            lead, trail = audio.silence_bounds(crop, sr)
+            spans[i, j] = (crop_start + lead) / sr, (crop_start + trail) / sr
+
+    contour = audio.track_pitch(y, sr)
+    return WordAnalysis(
+        spans, contour.f0, contour.voiced, contour.hop_length / sr, digest
+    )
+
+
+def analysis_path(word: str) -> str:
+    """where the analysis of a word is kept, next to its audio and alignment"""
+    return f"{cache_path(word)}.analysis.npz"
+
+
+def save_analysis(word: str, analysis: WordAnalysis) -> None:
+    path = analysis_path(word)
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    with open(tmp_path, "wb") as f:
+        np.savez(
+            f,
+            spans=analysis.spans,
+            f0=analysis.f0,
+            voiced=analysis.voiced,
+            hop_s=analysis.hop_s,
+            digest=analysis.digest,
+        )
+    os.replace(tmp_path, path)
+    analyses[word] = analysis
+
+
+analyses: Dict[str, WordAnalysis] = {}
+"""analyses already loaded by this process"""
+
+
+def load_analysis(word: str, digest: str) -> WordAnalysis | None:
+    """the analysis of the word, if there's one of the audio with this digest"""
+    if word in analyses and analyses[word].digest == digest:
+        return analyses[word]
+    try:
+        with np.load(analysis_path(word)) as data:
+            analysis = WordAnalysis(
+                data["spans"],
+                data["f0"],
+                data["voiced"],
+                float(data["hop_s"]),
+                str(data["digest"]),
+            )
+    except (OSError, ValueError, KeyError):
+        return None
+    if analysis.digest != digest:
+        # made from audio the word had before it was fetched again
+        return None
+    analyses[word] = analysis
+    return analysis
@@ -0,0 +1,159 @@
+from typing import Dict, Iterable, List, TypedDict
+from tts import WordInfo, audio_digest, cache_dir, cache_path
+from tracing import tracer
+from word_analysis import analyse_word, load_analysis, save_analysis
+import json
+import os
+import numpy as np
+
+
+class PackEntry(TypedDict):
+    offset: int
+    """index of the word's first sample in the pack's audio file"""
+
+    length: int
+    """number of samples"""
+
+    character_start_times: List[float]
+    character_end_times: List[float]
+    characters: List[str]
+
+    digest: str
+    """tts.audio_digest of the mp3 the samples were decoded from"""
+
+
+class WordPack:
+    """Every cached word's audio, decoded and resampled to sr once and stored
+    back to back in one float32 file, with an index of where each word starts
+    and its alignment. Words are read through a memory map, so getting one
+    doesn't copy or decode anything."""
+
+    def __init__(self, directory: str, sr: int):
+        self.directory = directory
+        self.sr = sr
+        self.audio_path = os.path.join(directory, "audio.f32")
+        self.index_path = os.path.join(directory, "index.json")
+        self.lock_path = os.path.join(directory, "lock")
+        self.index: Dict[str, PackEntry] = {}
+        self.samples: np.ndarray | None = None
+        os.makedirs(directory, exist_ok=True)
+        self.load_index()
+
+    def load_index(self) -> None:
+        if os.path.isfile(self.index_path):
+            with open(self.index_path) as f:
+                self.index = json.load(f)
+        self.samples = None
+
+    def current(self, word: str, digest: str) -> bool:
+        """whether the pack has the word, decoded from the audio with digest"""
+        return word in self.index and self.index[word].get("digest") == digest
+
+    def get(self, word: str, digest: str) -> np.ndarray:
+        if not self.current(word, digest):
+            # it may have been added (or updated) by another process
+            self.load_index()
+        entry = self.index[word]
+        if (
+            self.samples is None
+            or len(self.samples) < entry["offset"] + entry["length"]
+        ):
+            self.samples = np.memmap(self.audio_path, dtype=np.float32, mode="r")
+        return self.samples[entry["offset"] : entry["offset"] + entry["length"]]
+
+    def add(self, words: Dict[str, np.ndarray], infos: Dict[str, WordInfo]) -> None:
+        """Appends some words (already at the pack's sample rate) to the pack. A word
+        that's been fetched again replaces its old entry, whose samples are left
+        behind unused in the audio file. This
+        holds a lock while writing, so several renders can share a pack, except on
+        Windows, which has no fcntl, so only one render should use a pack at once."""
+        with open(self.lock_path, "w") as lock:
+            try:
+                import fcntl
+            except ImportError:
+                pass
+            else:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            # another process may have added words since we last looked
+            self.load_index()
+            with open(self.audio_path, "ab") as f:
+                offset = f.tell() // 4
+                for word, y in words.items():
+                    digest = audio_digest(word)
+                    if self.current(word, digest):
+                        continue
+                    f.write(np.ascontiguousarray(y, dtype=np.float32).tobytes())
+                    self.index[word] = {
+                        "offset": offset,
+                        "length": len(y),
+                        "character_start_times": infos[word]["character_start_times"],
+                        "character_end_times": infos[word]["character_end_times"],
+                        "characters": infos[word]["characters"],
+                        "digest": digest,
+                    }
+                    offset += len(y)
+            tmp_path = f"{self.index_path}.{os.getpid()}.tmp"
+            with open(tmp_path, "w") as f:
+                json.dump(self.index, f)
+            os.replace(tmp_path, self.index_path)
+            self.samples = None
+
+
+def pack_dir(sr: int, quality: str = "soxr_hq") -> str:
+    """where the pack of words resampled to sr with res_type quality lives"""
+    name = f"pack-{sr}" if quality == "soxr_hq" else f"pack-{sr}-{quality}"
+    return os.path.join(cache_dir(), name)
+
+
+packs: Dict[str, WordPack] = {}
+
+
+def open_pack(directory: str, sr: int) -> WordPack:
+    """The pack in directory, opened once per process"""
+    if directory not in packs:
+        packs[directory] = WordPack(directory, sr)
+    return packs[directory]
+
+
+def pack_words(
+    words: Iterable[str],
+    words_map: Dict[str, WordInfo],
+    sr: int,
+    quality: str = "soxr_hq",
+) -> WordPack:
+    """Makes sure every word is in the pack for sr, decoding the mp3s of any that
+    aren't yet, and that every word has been analysed (see word_analysis.py). This
+    is the only place word audio gets decoded or resampled from its original
+    rate."""
+    pack = open_pack(pack_dir(sr, quality), sr)
+    words = list(dict.fromkeys(words))
+    missing = [word for word in words if not pack.current(word, audio_digest(word))]
+    unanalysed = [
+        word for word in words if load_analysis(word, audio_digest(word)) is None
+    ]
+    if not missing and not unanalysed:
+        return pack
+
+    # only imported when there's something to decode, as it's slow to import
+    import audio
+
+    decoded: Dict[str, np.ndarray] = {}
+    for word in dict.fromkeys(missing + unanalysed):
+        with tracer.span("decode", word=word) as span:
+            y, word_sr = audio.segment_to_array(
+                audio.load_audio(f"{cache_path(word)}.mp3")
+            )
+            span["samples"] = len(y)
+        if word in unanalysed:
+            # at the word's own rate, so that nothing is lost to resampling
+            with tracer.span("analyse", word=word, samples=len(y)):
+                save_analysis(
+                    word,
+                    analyse_word(y, word_sr, words_map[word], audio_digest(word)),
+                )
+        if word in missing:
+            with tracer.span("resample", word=word, samples=len(y)):
+                decoded[word] = audio.resample(y, word_sr, sr, quality)
+    if decoded:
+        pack.add(decoded, words_map)
+    return pack